@@ -72,9 +72,6 @@ export default function AudioRecorder() {
     try {
       setStatusMessage("Uploading and analyzing audio...");
       
-      const fileBase64 = await FileSystem.readAsStringAsync(uri, {
-        encoding: FileSystem.EncodingType.Base64,
-      });
       const user = auth.currentUser;
         if (!user) {
          Alert.alert("Error", "User not logged in. Cannot save data.");
@@ -82,19 +79,20 @@ export default function AudioRecorder() {
          return;
         }
       const FLASK_SERVER_URL = "http://172.16.16.12:5000"; 
-
-      const response = await fetch(`${FLASK_SERVER_URL}/analyze-audio`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          audio_data : fileBase64, 
-          name: `Recording_${Date.now()}`,
-          user_uid: user.uid, 
-          duration_millis: duration * 1000
-        }),
+      const query = new URLSearchParams({
+        name: `Recording_${Date.now()}`,
+        user_uid: user.uid,
+        duration_millis: String(duration * 1000),
+      }).toString();
+
+      // ส่งไฟล์เสียงแบบ binary โดยตรง ไม่ต้องแปลงเป็น base64
+      const response = await FileSystem.uploadAsync(`${FLASK_SERVER_URL}/analyze-audio/binary?${query}`, uri, {
+        httpMethod: "POST",
+        uploadType: FileSystem.FileSystemUploadType.BINARY_CONTENT,
+        headers: { "Content-Type": "application/octet-stream" },
       });
 
-      const result = await response.json();
+      const result = JSON.parse(response.body);
       console.log("Analysis result:", result);
 
       if (response.status !== 200) {
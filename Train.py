@@ -1,39 +1,185 @@
-import tensorflow as tf
-import librosa
 import numpy as np
 import os
+import json
 import pickle
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelBinarizer 
-import matplotlib.pyplot as plt
+import hashlib
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from train_features import SAMPLE_RATE, MAX_LEN, N_MELS, compute_features, extract_features, extract_features_or_error
+
+# ProcessPoolExecutor บน Windows ใช้ spawn: worker ทุกตัวรันไฟล์นี้ซ้ำในชื่อ __mp_main__ ก่อนรับงาน
+# worker สกัดคุณลักษณะใช้แค่ train_features จึงข้ามการโหลด tensorflow/sklearn/matplotlib (หลายวินาทีและหลายร้อย MB ต่อ process)
+IN_SPAWNED_WORKER = __name__ == "__mp_main__"
+if not IN_SPAWNED_WORKER:
+    import tensorflow as tf
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import LabelBinarizer 
+    import matplotlib.pyplot as plt
 
 DATA_PATH = "C:/Users/Naruethep Sovajan/Desktop/Sound" 
-SAMPLE_RATE = 16000 
-MAX_LEN = 128       
-N_MELS = 128        
 MODEL_OUTPUT_DIR = "C:/Users/Naruethep Sovajan/Desktop/VoiceRe/SaveModel"
 model_save_path = "snoring_cnn_classifier_model.h5"
 label_encoder_path = "label_encoder.pkl"
+tflite_model_path = "snoring_cnn_classifier_model_int8.tflite"
+tflite_report_path = "tflite_comparison_report.json"
+CALIBRATION_SAMPLES = 500
+LATENCY_BATCH_SIZES = (1, 8, 32)  # ขนาด batch เดียวกับ MODEL_WARMUP_BATCH_SIZES ที่ server ใช้ (app.py)
+FEATURE_CACHE_DIR = os.path.join(MODEL_OUTPUT_DIR, "feature_cache")
+FEATURE_SHARD_SIZE = 512
+NUM_WORKERS = os.cpu_count() or 1
+EXTRACT_CHUNK_SIZE = 16
+BATCH_SIZE = 32
+SHUFFLE_BUFFER = 4096
+trained_manifest_path = "trained_files_manifest.json"
+incremental_report_path = "incremental_training_report.json"
+FINE_TUNE_LEARNING_RATE = 1e-4
+FINE_TUNE_EPOCHS = 10
+REPLAY_RATIO = 1.0
 
 
-def extract_features(file_path, sr=SAMPLE_RATE, n_mels=N_MELS, max_len=MAX_LEN):
-    try:
-        y, sr = librosa.load(file_path, sr=sr)
-        mel_spec = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=n_mels)
-        features = librosa.power_to_db(mel_spec, ref=np.max)
-        if features.shape[1] < max_len:
-            pad_width = max_len - features.shape[1]
-            features = np.pad(features, pad_width=((0, 0), (0, pad_width)), mode='constant')
+def iter_extract_features(file_paths, workers=NUM_WORKERS, chunksize=EXTRACT_CHUNK_SIZE):
+    # คืนค่า (features, error) ตามลำดับเดียวกับ file_paths เสมอ ไม่ว่าจะใช้กี่ process
+    progress = tqdm(total=len(file_paths), desc="Extracting features")
+    if workers <= 1:
+        for file_path in file_paths:
+            yield extract_features_or_error(file_path)
+            progress.update(1)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(extract_features_or_error, file_paths, chunksize=chunksize):
+                yield result
+                progress.update(1)
+    progress.close()
+
+def collect_audio_files(data_path=DATA_PATH):
+    items = []
+    for dirname, _, filenames in os.walk(data_path):
+        label = os.path.basename(dirname) 
+        if label in ['class1', 'class2']: 
+            for filename in filenames:
+                if filename.endswith(('.wav', '.mp3')):
+                    items.append((os.path.join(dirname, filename), label))
+    # เรียงลำดับไฟล์ให้คงที่ เพื่อให้ train_test_split(random_state=42) ได้ผลเหมือนเดิมทุกครั้ง
+    items.sort()
+    return items
+
+def load_cached_features(items, cache, workers=NUM_WORKERS, chunksize=EXTRACT_CHUNK_SIZE):
+    hashes = [file_content_hash(file_path) for file_path, _ in tqdm(items, desc="Hashing files")]
+    missing = [i for i, content_hash in enumerate(hashes) if content_hash not in cache]
+    print(f"ใช้คุณลักษณะจากแคช {len(items) - len(missing)} ไฟล์ สกัดใหม่ {len(missing)} ไฟล์")
+
+    failures = []
+    missing_paths = [items[i][0] for i in missing]
+    for i, (feature, error) in zip(missing, iter_extract_features(missing_paths, workers, chunksize)):
+        if error is not None:
+            failures.append((items[i][0], error))
         else:
-            features = features[:, :max_len]
-        features = np.expand_dims(features, axis=-1)
-        return features
-        
-    except Exception as e:
-        return None 
+            cache.put(hashes[i], feature)
+    cache.flush()
+
+    if failures:
+        print(f"\nสกัดคุณลักษณะไม่สำเร็จ {len(failures)} ไฟล์:")
+        for file_path, error in failures:
+            print(f" - {file_path}: {error}")
+    return hashes, failures
+
+def file_content_hash(file_path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class FeatureCache:
+    # คลังคุณลักษณะบนดิสก์ อ้างอิงด้วย hash ของเนื้อไฟล์ แยกโฟลเดอร์ตามพารามิเตอร์การสกัด
+    # สเปกโตรแกรมเก็บเป็น shard .npy และอ่านกลับแบบ memory-map
+
+    def __init__(self, root=FEATURE_CACHE_DIR, sr=SAMPLE_RATE, n_mels=N_MELS, max_len=MAX_LEN,
+                 shard_size=FEATURE_SHARD_SIZE):
+        self.params_key = f"sr{sr}_mels{n_mels}_len{max_len}"
+        self.directory = os.path.join(root, self.params_key)
+        self.index_path = os.path.join(self.directory, "index.json")
+        self.shard_size = shard_size
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        self._pending = {}
+        self._shards = {}
+
+    def __contains__(self, content_hash):
+        return content_hash in self.index or content_hash in self._pending
+
+    def __len__(self):
+        return len(self.index) + len(self._pending)
+
+    def get(self, content_hash):
+        if content_hash in self._pending:
+            return self._pending[content_hash]
+        entry = self.index.get(content_hash)
+        if entry is None:
+            return None
+        shard_name, row = entry
+        return self.open_shard(shard_name)[row]
+
+    def open_shard(self, shard_name):
+        if shard_name not in self._shards:
+            self._shards[shard_name] = np.load(os.path.join(self.directory, shard_name), mmap_mode='r')
+        return self._shards[shard_name]
+
+    def put(self, content_hash, feature):
+        if content_hash in self:
+            return
+        self._pending[content_hash] = feature.astype(np.float32, copy=False)
+        if len(self._pending) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        existing = [name for name in os.listdir(self.directory) if name.startswith("shard_") and name.endswith(".npy")]
+        shard_name = f"shard_{len(existing):05d}.npy"
+        shard_path = os.path.join(self.directory, shard_name)
+
+        hashes = list(self._pending)
+        with open(shard_path + ".tmp", 'wb') as f:
+            np.save(f, np.stack([self._pending[h] for h in hashes]))
+        os.replace(shard_path + ".tmp", shard_path)
+
+        for row, content_hash in enumerate(hashes):
+            self.index[content_hash] = [shard_name, row]
+        with open(self.index_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+        self._pending = {}
 
-def create_cnn_model(input_shape, num_classes=1):
+def make_streaming_dataset(cache, hashes, targets, batch_size=BATCH_SIZE, shuffle_buffer=0, seed=42):
+    # อ่านสเปกโตรแกรมจาก shard ทีละตัวอย่างขณะฝึก แทนการโหลดทั้งชุดข้อมูลเข้า RAM
+    locations = [cache.index[content_hash] for content_hash in hashes]
+    shard_names = sorted({shard_name for shard_name, _ in locations})
+    shard_ids = {shard_name: i for i, shard_name in enumerate(shard_names)}
+    shard_column = np.array([shard_ids[shard_name] for shard_name, _ in locations], dtype=np.int32)
+    row_column = np.array([row for _, row in locations], dtype=np.int32)
+
+    def read_row(shard_id, row):
+        return np.asarray(cache.open_shard(shard_names[shard_id])[row], dtype=np.float32)
+
+    def load_example(shard_id, row, target):
+        feature = tf.numpy_function(read_row, [shard_id, row], tf.float32)
+        feature.set_shape((N_MELS, MAX_LEN, 1))
+        return feature, target
+
+    dataset = tf.data.Dataset.from_tensor_slices((shard_column, row_column, targets.astype(np.float32)))
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.map(load_example, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+def create_cnn_model(input_shape, num_classes=1, jit_compile=False):
     model = tf.keras.models.Sequential([
 
         tf.keras.layers.Conv2D(32, kernel_size=(3, 3), activation='relu', input_shape=input_shape, padding='same'),
@@ -58,15 +204,54 @@ def create_cnn_model(input_shape, num_classes=1):
         tf.keras.layers.BatchNormalization(),
         tf.keras.layers.Dropout(0.5),
 
-        tf.keras.layers.Dense(num_classes, activation='sigmoid')
+        # ชั้นสุดท้ายคำนวณเป็น float32 เสมอ เพื่อให้ sigmoid/loss เสถียรเมื่อใช้ mixed precision
+        tf.keras.layers.Dense(num_classes, activation='sigmoid', dtype='float32')
     ])
     model.compile(
         optimizer=tf.keras.optimizers.Adam(learning_rate=0.001),
         loss='binary_crossentropy', 
-        metrics=['accuracy']
+        metrics=['accuracy'],
+        jit_compile=jit_compile
     )
     return model
 
+class ThroughputCallback(object if IN_SPAWNED_WORKER else tf.keras.callbacks.Callback):
+    # วัดจำนวนตัวอย่างต่อวินาทีของช่วง train ในแต่ละ epoch (ไม่รวมเวลา validation)
+    def __init__(self, num_samples):
+        super().__init__()
+        self.num_samples = num_samples
+        self.samples_per_sec = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._started = time.perf_counter()
+        self._train_seconds = None
+
+    def on_test_begin(self, logs=None):
+        if self._train_seconds is None:
+            self._train_seconds = time.perf_counter() - self._started
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = self._train_seconds if self._train_seconds is not None else time.perf_counter() - self._started
+        rate = self.num_samples / seconds
+        self.samples_per_sec.append(rate)
+        if logs is not None:
+            logs['samples_per_sec'] = rate
+        print(f"\nEpoch {epoch + 1}: {rate:.1f} samples/sec ({seconds:.1f} s)")
+
+def configure_threads(intra_op=None, inter_op=None):
+    # ต้องเรียกก่อนที่ TensorFlow จะเริ่มรัน op ใดๆ
+    if intra_op:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+    if inter_op:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+
+def to_float32_model(model, input_shape):
+    # คัดลอกน้ำหนักไปยังโมเดล float32 เพื่อให้ไฟล์ .h5 ที่เซิร์ฟเวอร์โหลดไม่ขึ้นกับ policy ตอนฝึก
+    tf.keras.mixed_precision.set_global_policy('float32')
+    float32_model = create_cnn_model(input_shape=input_shape, num_classes=1)
+    float32_model.set_weights(model.get_weights())
+    return float32_model
+
 def plot_training_history(history):
     plt.figure(figsize=(12, 4))
     
@@ -88,69 +273,243 @@ def plot_training_history(history):
     
     plt.show()
 
-def main():   
-    print("="*50)
-    print("ระบบฝึกโมเดลตรวจจับเสียงกรนแบบ 2D-CNN Classification")
-    print("="*50)
-    print("\nโหลดและสกัดคุณลักษณะข้อมูล")
+def prepare_dataset(workers=NUM_WORKERS, chunksize=EXTRACT_CHUNK_SIZE, encoder=None):
+    cache = FeatureCache()
+    items = collect_audio_files()
+    hashes, _ = load_cached_features(items, cache, workers=workers, chunksize=chunksize)
     
-    features = []
+    kept_hashes = []
     labels = []
-    
-    for dirname, _, filenames in os.walk(DATA_PATH):
-        label = os.path.basename(dirname) 
-        if label in ['class1', 'class2']: 
-            for filename in tqdm(filenames, desc=f"Processing {label} files"):
-                if filename.endswith(('.wav', '.mp3')):
-                    file_path = os.path.join(dirname, filename)
-                    feature = extract_features(file_path)
-                    
-                    if feature is not None and feature.shape == (N_MELS, MAX_LEN, 1):
-                        features.append(feature)
-                        labels.append(label)
-
-    X = np.array(features)
+    for (file_path, label), content_hash in zip(items, hashes):
+        if content_hash in cache:
+            kept_hashes.append(content_hash)
+            labels.append(label)
     y_str = np.array(labels) 
 
-    print(f"\nพบข้อมูลทั้งหมดที่ประมวลผลได้: {len(X)} ตัวอย่าง")
+    print(f"\nพบข้อมูลทั้งหมดที่ประมวลผลได้: {len(y_str)} ตัวอย่าง")
     
-    encoder = LabelBinarizer()
-    Y = encoder.fit_transform(y_str)
+    # โหมด incremental ใช้ encoder เดิมที่บันทึกไว้ เพื่อให้ label ตรงกับโมเดลที่โหลดมา
+    if encoder is None:
+        encoder = LabelBinarizer()
+        Y = encoder.fit_transform(y_str)
+    else:
+        Y = encoder.transform(y_str)
     
     if Y.ndim == 1:
         Y = Y.reshape(-1, 1) 
     
-    X_train, X_val, Y_train, Y_val = train_test_split(
-        X, Y, test_size=0.2, random_state=42, stratify=Y 
+    # แบ่งเฉพาะ index ของตัวอย่าง จึงได้ผลเหมือน train_test_split(X, Y, ...) เดิมทุกประการ
+    train_idx, val_idx = train_test_split(
+        np.arange(len(Y)), test_size=0.2, random_state=42, stratify=Y 
     )
-    
+    return cache, kept_hashes, Y, encoder, train_idx, val_idx
+
+def tflite_predict(interpreter, X, batch_size=1):
+    # รันโมเดล TFLite ทีละ batch_size ตัวอย่าง (batch สุดท้ายเติมศูนย์ให้เต็ม) แปลง input/output ตาม scale และ zero point ของโมเดล int8
+    input_details = interpreter.get_input_details()[0]
+    if input_details["shape"][0] != batch_size:
+        interpreter.resize_tensor_input(input_details["index"], [batch_size, *input_details["shape"][1:]])
+        interpreter.allocate_tensors()
+        input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    in_scale, in_zero = input_details["quantization"]
+    out_scale, out_zero = output_details["quantization"]
+    outputs = []
+    for start in range(0, len(X), batch_size):
+        batch = X[start:start + batch_size]
+        x = np.zeros((batch_size, *X.shape[1:]), dtype=np.float32)
+        x[:len(batch)] = batch
+        if input_details["dtype"] == np.int8:
+            x = np.clip(np.round(x / in_scale + in_zero), -128, 127).astype(np.int8)
+        interpreter.set_tensor(input_details["index"], x)
+        interpreter.invoke()
+        y = interpreter.get_tensor(output_details["index"])[:len(batch)]
+        if output_details["dtype"] == np.int8:
+            y = (y.astype(np.float32) - out_zero) * out_scale
+        outputs.append(y)
+    return np.concatenate(outputs)
+
+def keras_predict(model, X, batch_size=1):
+    # เรียกโมเดลตรง ๆ ทีละ batch แทน model.predict() ซึ่งมีค่าใช้จ่ายในการตั้งค่าทุกครั้งที่เรียก
+    return np.concatenate([model(X[i:i + batch_size], training=False).numpy() for i in range(0, len(X), batch_size)])
+
+def time_per_sample(predict, X, batch_size):
+    # เรียกหนึ่ง batch ก่อนจับเวลา เพื่อไม่นับการ trace/allocate ครั้งแรก
+    predict(X[:batch_size], batch_size)
+    started = time.perf_counter()
+    probabilities = predict(X, batch_size)[:, 0]
+    return probabilities, (time.perf_counter() - started) / len(X)
+
+def export_tflite(workers=NUM_WORKERS, chunksize=EXTRACT_CHUNK_SIZE, calibration_samples=CALIBRATION_SAMPLES):
+    print("\nแปลงโมเดลเป็น TFLite แบบ int8 (post-training quantization)")
+    cache, kept_hashes, Y, encoder, train_idx, val_idx = prepare_dataset(workers=workers, chunksize=chunksize)
+    keras_model = tf.keras.models.load_model(model_save_path)
+
+    # ใช้ตัวอย่างจากชุด train เท่านั้นในการ calibrate เพื่อไม่ให้รายงานความแม่นยำบน validation ลำเอียง
+    rng = np.random.default_rng(42)
+    calibration_idx = rng.choice(train_idx, size=min(calibration_samples, len(train_idx)), replace=False)
+
+    def representative_dataset():
+        for i in calibration_idx:
+            yield [np.asarray(cache.get(kept_hashes[i]), dtype=np.float32)[np.newaxis]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    tflite_model = converter.convert()
+    with open(tflite_model_path, 'wb') as f:
+        f.write(tflite_model)
+    print(f" บันทึกโมเดล TFLite เรียบร้อยที่: {tflite_model_path}")
+
+    print("\nเปรียบเทียบความแม่นยำและความเร็วกับโมเดล Keras (ชุด validation)")
+    X_val = np.stack([cache.get(kept_hashes[i]) for i in val_idx]).astype(np.float32)
+    Y_val = Y[val_idx, 0]
+
+    # จับเวลาทั้งสองแบบด้วยขนาด batch เดียวกัน ตามที่ server ส่งเข้าโมเดลจริง
+    interpreter = tf.lite.Interpreter(model_path=tflite_model_path)
+    interpreter.allocate_tensors()
+    keras_latency, tflite_latency = {}, {}
+    for batch_size in LATENCY_BATCH_SIZES:
+        keras_prob, keras_latency[str(batch_size)] = time_per_sample(
+            lambda X, b: keras_predict(keras_model, X, b), X_val, batch_size
+        )
+        tflite_prob, tflite_latency[str(batch_size)] = time_per_sample(
+            lambda X, b: tflite_predict(interpreter, X, b), X_val, batch_size
+        )
+
+    keras_pred = keras_prob > 0.5
+    tflite_pred = tflite_prob > 0.5
+    report = {
+        "validation_samples": int(len(X_val)),
+        "calibration_samples": int(len(calibration_idx)),
+        "keras": {
+            "accuracy": float(np.mean(keras_pred == Y_val)),
+            "latency_ms_per_sample_by_batch_size": {b: 1000 * t for b, t in keras_latency.items()},
+            "model_bytes": os.path.getsize(model_save_path),
+        },
+        "tflite_int8": {
+            "accuracy": float(np.mean(tflite_pred == Y_val)),
+            "latency_ms_per_sample_by_batch_size": {b: 1000 * t for b, t in tflite_latency.items()},
+            "model_bytes": os.path.getsize(tflite_model_path),
+        },
+        "prediction_agreement": float(np.mean(keras_pred == tflite_pred)),
+        "max_probability_difference": float(np.max(np.abs(keras_prob - tflite_prob))) if len(X_val) else 0.0,
+    }
+    with open(tflite_report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print(f" บันทึกรายงานเปรียบเทียบเรียบร้อยที่: {tflite_report_path}")
+
+def make_fit_inputs(cache, kept_hashes, Y, train_idx, val_idx, batch_size=BATCH_SIZE, streaming=False):
+    if streaming:
+        print("\nโหมด streaming: อ่านคุณลักษณะจาก shard ระหว่างฝึก")
+        train_data = make_streaming_dataset(
+            cache, [kept_hashes[i] for i in train_idx], Y[train_idx],
+            batch_size=batch_size, shuffle_buffer=SHUFFLE_BUFFER
+        )
+        val_data = make_streaming_dataset(cache, [kept_hashes[i] for i in val_idx], Y[val_idx], batch_size=batch_size)
+        return {"x": train_data, "validation_data": val_data}
+
+    X_train = np.stack([cache.get(kept_hashes[i]) for i in train_idx])
+    X_val = np.stack([cache.get(kept_hashes[i]) for i in val_idx])
+    Y_train, Y_val = Y[train_idx], Y[val_idx]
     print(f"X_train.shape: {X_train.shape}")
-    print(f"Y_train.shape: {Y_train.shape}")
+    return {"x": X_train, "y": Y_train, "batch_size": batch_size, "validation_data": (X_val, Y_val)}
 
-    print("\nสร้างโมเดล 2D-CNN")
-    input_shape = X_train.shape[1:] 
-    
-    cnn_model = create_cnn_model(input_shape=input_shape, num_classes=1) 
+def evaluate_accuracy(model, cache, kept_hashes, Y, idx, batch_size=BATCH_SIZE):
+    if len(idx) == 0:
+        return None
+    X = np.stack([cache.get(kept_hashes[i]) for i in idx]).astype(np.float32)
+    probabilities = model.predict(X, batch_size=batch_size, verbose=0)[:, 0]
+    return float(np.mean((probabilities > 0.5) == Y[idx, 0]))
+
+def load_trained_manifest():
+    # คืนค่า (hash ชุด train, hash ชุด validation) หรือ None ถ้ายังไม่มี manifest
+    if not os.path.exists(trained_manifest_path):
+        return None
+    with open(trained_manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if "val_hashes" not in manifest:
+        raise SystemExit("manifest เดิมไม่มีรายการชุด validation กรุณาฝึกแบบเต็มหนึ่งครั้งก่อนใช้ --incremental")
+    return set(manifest["hashes"]), set(manifest["val_hashes"])
+
+def save_trained_manifest(hashes, val_hashes):
+    # รายการ hash ของไฟล์ที่โมเดลปัจจุบันเคยเห็นแล้ว ใช้แยกไฟล์ใหม่ในโหมด incremental
+    # และเก็บชุด validation ไว้ด้วย เพื่อให้ไฟล์เดิมอยู่ฝั่งเดิมเสมอเมื่อมีไฟล์ใหม่เข้ามา
+    with open(trained_manifest_path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump({
+            "hashes": sorted(hashes),
+            "val_hashes": sorted(val_hashes),
+            "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+        }, f)
+    os.replace(trained_manifest_path + ".tmp", trained_manifest_path)
+
+def split_new_files(new_all_idx, Y):
+    # แบ่งเฉพาะไฟล์ใหม่เป็น train/validation ในสัดส่วนเดียวกับ prepare_dataset
+    if len(new_all_idx) < 2:
+        return new_all_idx, new_all_idx[:0]
+    try:
+        return train_test_split(new_all_idx, test_size=0.2, random_state=42, stratify=Y[new_all_idx])
+    except ValueError:
+        # ไฟล์ใหม่น้อยเกินกว่าจะแบ่งตามสัดส่วน class ได้
+        return train_test_split(new_all_idx, test_size=0.2, random_state=42)
+
+def train_from_scratch(fit_inputs, input_shape, num_samples, jit_compile=False):
+    cnn_model = create_cnn_model(input_shape=input_shape, num_classes=1, jit_compile=jit_compile) 
     cnn_model.summary()
+    throughput = ThroughputCallback(num_samples)
 
     print("\nเริ่มฝึกโมเดล")
     history = cnn_model.fit(
-        X_train, Y_train,  
         epochs=100,
-        batch_size=32, 
-        validation_data=(X_val, Y_val), 
         callbacks=[
             tf.keras.callbacks.EarlyStopping(patience=15, restore_best_weights=True), 
-            tf.keras.callbacks.ReduceLROnPlateau(factor=0.5, patience=7) 
+            tf.keras.callbacks.ReduceLROnPlateau(factor=0.5, patience=7),
+            throughput
         ],
-        verbose=1
+        verbose=1,
+        **fit_inputs
     )
+    return cnn_model, history, throughput
+
+def main(workers=NUM_WORKERS, chunksize=EXTRACT_CHUNK_SIZE, streaming=False, batch_size=BATCH_SIZE,
+         jit_compile=False, bfloat16=False):   
+    print("="*50)
+    print("ระบบฝึกโมเดลตรวจจับเสียงกรนแบบ 2D-CNN Classification")
+    print("="*50)
+    print("\nโหลดและสกัดคุณลักษณะข้อมูล")
+    
+    cache, kept_hashes, Y, encoder, train_idx, val_idx = prepare_dataset(workers=workers, chunksize=chunksize)
+    input_shape = (N_MELS, MAX_LEN, 1)
+
+    fit_inputs = make_fit_inputs(cache, kept_hashes, Y, train_idx, val_idx, batch_size=batch_size, streaming=streaming)
+    print(f"Y_train.shape: {Y[train_idx].shape}")
+
+    print("\nสร้างโมเดล 2D-CNN")
+    if bfloat16:
+        print("ใช้ mixed precision แบบ bfloat16")
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    if jit_compile:
+        print("คอมไพล์ขั้นตอนการฝึกด้วย XLA (jit_compile)")
+    
+    cnn_model, history, throughput = train_from_scratch(fit_inputs, input_shape, len(train_idx), jit_compile=jit_compile)
+
+    if throughput.samples_per_sec:
+        print(f"\nความเร็วเฉลี่ย: {np.mean(throughput.samples_per_sec):.1f} samples/sec "
+              f"(batch_size={batch_size}, xla={jit_compile}, bf16={bfloat16})")
 
     plot_training_history(history)
 
+    if bfloat16:
+        cnn_model = to_float32_model(cnn_model, input_shape)
+
     print("\n บันทึกโมเดล")
     os.makedirs(MODEL_OUTPUT_DIR, exist_ok=True) 
     cnn_model.save(model_save_path)
+    save_trained_manifest({kept_hashes[i] for i in train_idx}, {kept_hashes[i] for i in val_idx})
     print(f" บันทึกโมเดลเรียบร้อยที่: {model_save_path}")
 
     try:
@@ -160,5 +519,129 @@ def main():
     except Exception as e:
         print(f" เกิดข้อผิดพลาดในการบันทึก Label Encoder: {e}")
 
+def incremental_train(workers=NUM_WORKERS, chunksize=EXTRACT_CHUNK_SIZE, streaming=False, batch_size=BATCH_SIZE,
+                      jit_compile=False, compare_full=False, learning_rate=FINE_TUNE_LEARNING_RATE,
+                      epochs=FINE_TUNE_EPOCHS, replay_ratio=REPLAY_RATIO):
+    print("="*50)
+    print("ฝึกโมเดลต่อจากโมเดลเดิม (incremental fine-tuning)")
+    print("="*50)
+
+    manifest = load_trained_manifest()
+    if manifest is None or not os.path.exists(model_save_path) or not os.path.exists(label_encoder_path):
+        raise SystemExit("ไม่พบโมเดล, label encoder หรือ manifest เดิม กรุณาฝึกแบบเต็มก่อน")
+    trained, validated = manifest
+    with open(label_encoder_path, 'rb') as f:
+        encoder = pickle.load(f)
+
+    # ไฟล์ที่เคยสกัดแล้วจะอ่านจากแคช จึงสกัดเฉพาะไฟล์ที่เพิ่มเข้ามาใหม่
+    # ไม่ใช้การสุ่มแบ่งใหม่ของ prepare_dataset: ไฟล์เดิมอยู่ฝั่ง train/validation ตาม manifest
+    # และสุ่มแบ่งเฉพาะไฟล์ที่เพิ่มเข้ามาใหม่
+    cache, kept_hashes, Y, encoder, _, _ = prepare_dataset(workers=workers, chunksize=chunksize, encoder=encoder)
+    old_idx = np.array([i for i, h in enumerate(kept_hashes) if h in trained], dtype=np.int64)
+    old_val_idx = np.array([i for i, h in enumerate(kept_hashes) if h in validated and h not in trained], dtype=np.int64)
+    new_all_idx = np.array([i for i, h in enumerate(kept_hashes) if h not in trained and h not in validated], dtype=np.int64)
+    new_idx, new_val_idx = split_new_files(new_all_idx, Y)
+    train_idx = np.concatenate([old_idx, new_idx])
+    val_idx = np.concatenate([old_val_idx, new_val_idx])
+    if len(new_idx) == 0:
+        print("ไม่มีไฟล์ใหม่สำหรับฝึก")
+        return
+
+    # ผสมข้อมูลเก่าบางส่วน (replay) เพื่อไม่ให้โมเดลลืมสิ่งที่เรียนไปแล้ว
+    rng = np.random.default_rng(42)
+    replay_size = min(len(old_idx), int(round(replay_ratio * len(new_idx))))
+    replay_idx = rng.choice(old_idx, size=replay_size, replace=False) if replay_size else old_idx[:0]
+    fine_tune_idx = np.concatenate([new_idx, replay_idx])
+    print(f"ไฟล์ใหม่ {len(new_idx)} ไฟล์, replay ข้อมูลเก่า {len(replay_idx)} ไฟล์, validation {len(val_idx)} ไฟล์")
+
+    model = tf.keras.models.load_model(model_save_path)
+    base_accuracy = evaluate_accuracy(model, cache, kept_hashes, Y, val_idx, batch_size)
+    base_new_accuracy = evaluate_accuracy(model, cache, kept_hashes, Y, new_val_idx, batch_size)
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+        loss='binary_crossentropy',
+        metrics=['accuracy'],
+        jit_compile=jit_compile
+    )
+
+    fit_inputs = make_fit_inputs(cache, kept_hashes, Y, fine_tune_idx, val_idx, batch_size=batch_size, streaming=streaming)
+    throughput = ThroughputCallback(len(fine_tune_idx))
+    started = time.perf_counter()
+    model.fit(
+        epochs=epochs,
+        callbacks=[tf.keras.callbacks.EarlyStopping(patience=3, restore_best_weights=True), throughput],
+        verbose=1,
+        **fit_inputs
+    )
+    incremental_seconds = time.perf_counter() - started
+
+    report = {
+        "new_train_files": int(len(new_idx)),
+        "replay_files": int(len(replay_idx)),
+        "validation_files": int(len(val_idx)),
+        "new_validation_files": int(len(new_val_idx)),
+        "learning_rate": learning_rate,
+        "base_model": {"val_accuracy": base_accuracy, "new_val_accuracy": base_new_accuracy},
+        "incremental": {
+            "val_accuracy": evaluate_accuracy(model, cache, kept_hashes, Y, val_idx, batch_size),
+            "new_val_accuracy": evaluate_accuracy(model, cache, kept_hashes, Y, new_val_idx, batch_size),
+            "seconds": incremental_seconds,
+        },
+    }
+
+    if compare_full:
+        print("\nฝึกแบบเต็มจากศูนย์เพื่อเปรียบเทียบ (ไม่บันทึกทับโมเดล)")
+        full_inputs = make_fit_inputs(cache, kept_hashes, Y, train_idx, val_idx, batch_size=batch_size, streaming=streaming)
+        started = time.perf_counter()
+        full_model, _, _ = train_from_scratch(full_inputs, (N_MELS, MAX_LEN, 1), len(train_idx), jit_compile=jit_compile)
+        report["full_retrain"] = {
+            "val_accuracy": evaluate_accuracy(full_model, cache, kept_hashes, Y, val_idx, batch_size),
+            "new_val_accuracy": evaluate_accuracy(full_model, cache, kept_hashes, Y, new_val_idx, batch_size),
+            "seconds": time.perf_counter() - started,
+        }
+
+    print("\n บันทึกโมเดล")
+    model.save(model_save_path)
+    save_trained_manifest(trained | {kept_hashes[i] for i in new_idx}, validated | {kept_hashes[i] for i in new_val_idx})
+    print(f" บันทึกโมเดลเรียบร้อยที่: {model_save_path}")
+
+    with open(incremental_report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print(f" บันทึกรายงานเรียบร้อยที่: {incremental_report_path}")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Train the snoring 2D-CNN classifier")
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS,
+                        help="number of feature extraction processes (1 = run in this process)")
+    parser.add_argument("--chunksize", type=int, default=EXTRACT_CHUNK_SIZE,
+                        help="files sent to a worker process per task")
+    parser.add_argument("--streaming", action="store_true",
+                        help="stream features from the on-disk cache with tf.data instead of loading them into RAM")
+    parser.add_argument("--export-tflite", action="store_true",
+                        help="quantize the saved model to int8 TFLite and write an accuracy/latency comparison report")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="training batch size")
+    parser.add_argument("--xla", action="store_true", help="compile the training step with XLA (jit_compile)")
+    parser.add_argument("--bf16", action="store_true",
+                        help="train with mixed_bfloat16 precision; the saved model is converted back to float32")
+    parser.add_argument("--threads", type=int, default=None, help="TensorFlow intra-op threads (default: all cores)")
+    parser.add_argument("--inter-op-threads", type=int, default=None, help="TensorFlow inter-op threads")
+    parser.add_argument("--incremental", action="store_true",
+                        help="fine-tune the saved model on files not in the trained-files manifest plus a replay sample")
+    parser.add_argument("--compare-full", action="store_true",
+                        help="with --incremental, also train from scratch and report both accuracies")
+    parser.add_argument("--fine-tune-lr", type=float, default=FINE_TUNE_LEARNING_RATE)
+    parser.add_argument("--fine-tune-epochs", type=int, default=FINE_TUNE_EPOCHS)
+    parser.add_argument("--replay-ratio", type=float, default=REPLAY_RATIO,
+                        help="old training files replayed per new file")
+    args = parser.parse_args()
+    configure_threads(args.threads, args.inter_op_threads)
+    if args.export_tflite:
+        export_tflite(workers=args.workers, chunksize=args.chunksize)
+    elif args.incremental:
+        incremental_train(workers=args.workers, chunksize=args.chunksize, streaming=args.streaming,
+                          batch_size=args.batch_size, jit_compile=args.xla, compare_full=args.compare_full,
+                          learning_rate=args.fine_tune_lr, epochs=args.fine_tune_epochs, replay_ratio=args.replay_ratio)
+    else:
+        main(workers=args.workers, chunksize=args.chunksize, streaming=args.streaming, batch_size=args.batch_size,
+             jit_compile=args.xla, bfloat16=args.bf16)
\ No newline at end of file
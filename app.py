@@ -1,20 +1,48 @@
 import os
 import io
 import base64
+import time
+import queue
+import threading
+import uuid
+import wave
+import json
+import hashlib
+import sqlite3
+import argparse
+import multiprocessing
+import mimetypes
+import subprocess
+import tempfile
+import contextvars
 import librosa
+import soxr
 import numpy as np
 import psycopg2
-from flask import Flask, request, jsonify, send_from_directory
-from tensorflow.keras.models import load_model
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+from contextlib import contextmanager
+from collections import OrderedDict
+from flask import Flask, Response, g, request, jsonify, send_from_directory
 from datetime import datetime
 from pydub import AudioSegment
+from pydub.utils import mediainfo_json
 from datetime import datetime, timedelta
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from flask_cors import CORS 
 
 app = Flask(__name__)
 CORS(app) 
 
 MODEL_PATH = r"C:\Users\Naruethep Sovajan\Desktop\VoiceRe\SaveModel\snoring_cnn_classifier_model.h5"
+TFLITE_MODEL_PATH = r"C:\Users\Naruethep Sovajan\Desktop\VoiceRe\SaveModel\snoring_cnn_classifier_model_int8.tflite"
+# "keras" serves the .h5 through TensorFlow; "tflite" serves the int8 model exported by
+# `python Train.py --export-tflite` and only needs tflite_runtime.
+INFERENCE_BACKEND = os.environ.get("SNORING_INFERENCE_BACKEND", "keras")
+TFLITE_NUM_THREADS = 2
+MODEL_WATCH_INTERVAL_SECONDS = 30
+MODEL_WARMUP_BATCH_SIZES = (1, 8, 32)
 if not os.path.exists(MODEL_PATH):
     print(f"Warning: Model file not found at: {MODEL_PATH}")
 DB_CONFIG = {
@@ -23,25 +51,893 @@ DB_CONFIG = {
     "password": "louis23zx",  
     "host": "localhost"
 }
+DB_POOL_MIN_CONNECTIONS = 1
+DB_POOL_MAX_CONNECTIONS = 10
+DB_POOL_WAIT_SECONDS = 10
+DB_HEALTHCHECK_IDLE_SECONDS = 30
+RECORDINGS_PAGE_SIZE = 50
+RECORDINGS_MAX_PAGE_SIZE = 500
+RECORDINGS_STREAM_ITERSIZE = 500
+READ_CACHE_MAX_ENTRIES = 10000
+READ_CACHE_TTL_SECONDS = 300
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+METRICS_SIZE_BUCKETS = tuple(2 ** n for n in range(14, 30, 2))  # 16 KB .. 512 MB
+METRICS_DURATION_BUCKETS = (10, 60, 300, 900, 1800, 3600, 7200, 14400, 28800, 43200)
+# Requests carrying this header get their stage breakdown back in a Server-Timing header.
+TRACE_REQUEST_HEADER = "X-Trace-Stages"
 
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Codec for stored recordings: extension, ffmpeg container and ffmpeg codec arguments.
+# FLAC is lossless (roughly half the size of WAV); Opus is far smaller but lossy.
+STORAGE_FORMATS = {
+    "flac": (".flac", "flac", ["-c:a", "flac", "-compression_level", "5"]),
+    "opus": (".ogg", "ogg", ["-c:a", "libopus", "-b:a", "32k"]),
+    "wav": (".wav", "wav", []),
+}
+STORAGE_FORMAT = os.environ.get("SNORING_STORAGE_FORMAT", "flac")
+mimetypes.add_type("audio/flac", ".flac")
+mimetypes.add_type("audio/ogg", ".ogg")
+
+TARGET_SR = 16000
+CHUNK_SECONDS = 4.0
+SILENCE_THRESHOLD = 0.01
+MIN_SILENCE_DURATION = 5
+# Chunks whose loudest 1-second RMS stays below this cannot hold a snore and skip the
+# spectrogram and CNN; 0 disables the gate.
+ENERGY_GATE_RMS = float(os.environ.get("SNORING_ENERGY_GATE_RMS", SILENCE_THRESHOLD))
+FEATURE_BATCH_CHUNKS = 64
+RMS_BLOCK_SECONDS = 600
+INFERENCE_MAX_BATCH_SIZE = 256
+INFERENCE_MAX_WAIT_SECONDS = 0.02
+ANALYSIS_BLOCK_SECONDS = 600
+# Stored timelines: one int8 dB value per second and one uint8 probability (x255) per chunk.
+ENVELOPE_DEFAULT_POINTS = 500
+ENVELOPE_MAX_POINTS = 20000
+# Uploads at least this large are spooled to disk and decoded/resampled in
+# STREAM_BLOCK_SECONDS blocks instead of being decoded whole; 0 streams everything.
+STREAMING_ANALYSIS_MIN_BYTES = int(os.environ.get("SNORING_STREAMING_MIN_BYTES", 32 * 1024 * 1024))
+STREAM_BLOCK_SECONDS = 60
+UPLOAD_SPOOL_BLOCK_BYTES = 1024 * 1024
+# Retried uploads (same user and audio bytes, or same Idempotency-Key) return the first result.
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+DUPLICATE_UPLOAD_WAIT_SECONDS = 600
+
+JOBS_FOLDER = os.path.join(UPLOAD_FOLDER, "jobs")
+JOB_DB_PATH = os.path.join(JOBS_FOLDER, "jobs.sqlite3")
+JOB_WORKERS = 2
+JOB_QUEUE_MAX = 32
+os.makedirs(JOBS_FOLDER, exist_ok=True)
+
+
+class KerasBackend:
+    """Float Keras model; imports TensorFlow only when selected."""
+    name = "keras"
+
+    def __init__(self, path):
+        from tensorflow.keras.models import load_model
+        self.model = load_model(path)
+
+    def predict(self, X):
+        return self.model.predict(X, batch_size=INFERENCE_MAX_BATCH_SIZE, verbose=0)
+
+
+class TFLiteBackend:
+    """
+    Int8-quantized TFLite model. Inputs are quantized with the model's own scale and
+    zero point and outputs dequantized, so predict() returns the same (n, 1)
+    probabilities as KerasBackend. Batches are padded to a power of two so the
+    interpreter is only re-allocated for a handful of shapes.
+    """
+    name = "tflite"
+
+    def __init__(self, path, num_threads=TFLITE_NUM_THREADS):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def _resize(self, batch):
+        input_index = self.interpreter.get_input_details()[0]["index"]
+        shape = self.interpreter.get_input_details()[0]["shape"]
+        self.interpreter.resize_tensor_input(input_index, [batch, *shape[1:]])
+        self.interpreter.allocate_tensors()
+        self._batch = batch
+
+    def predict(self, X):
+        n = len(X)
+        padded = 1 << max(0, (n - 1).bit_length())
+        with self._lock:
+            if self._batch != padded:
+                self._resize(padded)
+            input_details = self.interpreter.get_input_details()[0]
+            output_details = self.interpreter.get_output_details()[0]
+
+            X_in = np.zeros((padded, *X.shape[1:]), dtype=np.float32)
+            X_in[:n] = X
+            if input_details["dtype"] == np.int8:
+                scale, zero_point = input_details["quantization"]
+                X_in = np.clip(np.round(X_in / scale + zero_point), -128, 127).astype(np.int8)
+            self.interpreter.set_tensor(input_details["index"], X_in)
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(output_details["index"])[:n]
+
+        if output_details["dtype"] == np.int8:
+            scale, zero_point = output_details["quantization"]
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+
+INFERENCE_BACKENDS = {
+    "keras": (KerasBackend, MODEL_PATH),
+    "tflite": (TFLiteBackend, TFLITE_MODEL_PATH),
+}
+
+def model_file_version(path):
+    """Identifies a model file by name and content hash, e.g. "model.h5:3f2a9c81d0e4"."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return f"{os.path.basename(path)}:{digest.hexdigest()[:12]}"
+
+
+class ModelRegistry:
+    """
+    Owns the model being served as an immutable (version, backend) pair.
+
+    A new model file is loaded and warmed up on dummy batches in a background thread
+    and then published with a single reference assignment. Analyses pin the pair
+    they started with, so requests already in flight finish on the old model while
+    new ones pick up the new one.
+    """
+
+    def __init__(self, backend_name=INFERENCE_BACKEND, watch_interval=MODEL_WATCH_INTERVAL_SECONDS):
+        self.backend_name = backend_name
+        self.path = INFERENCE_BACKENDS[backend_name][1]
+        self.watch_interval = watch_interval
+        self._current = None
+        self._load_lock = threading.Lock()
+        self._watcher = None
+        self._watched_mtime = None
+        self.loading = False
+        self.loaded_at = None
+        self.last_error = None
+
+    def current(self):
+        """The serving (version, backend) pair, loading the configured model on first use."""
+        if self._current is None:
+            try:
+                self.load()
+            except Exception as e:
+                print(f"Error loading model: {e}")
+        return self._current
+
+    @property
+    def serving(self):
+        """The serving (version, backend) pair, or None; unlike current() it never loads."""
+        return self._current
+
+    def load(self, path=None, backend_name=None):
+        """Loads, warms up and publishes a model; blocks until it is serving."""
+        with self._load_lock:
+            backend_name = backend_name or self.backend_name
+            path = path or self.path
+            self.loading = True
+            try:
+                mtime = os.path.getmtime(path)
+                version = model_file_version(path)
+                backend = INFERENCE_BACKENDS[backend_name][0](path)
+                for batch_size in MODEL_WARMUP_BATCH_SIZES:
+                    backend.predict(np.zeros((batch_size, 128, 128, 1), dtype=np.float32))
+            except Exception as e:
+                self.last_error = str(e)
+                raise
+            finally:
+                self.loading = False
+
+            self.backend_name, self.path, self._watched_mtime = backend_name, path, mtime
+            self._current = (version, backend)
+            self.loaded_at = datetime.now()
+            self.last_error = None
+            print(f"Snoring detection model loaded successfully ({backend_name}, {version}).")#ดักจับข้อผิดพลาดในการโหลดโมเดล
+            return version
+
+    def reload_async(self, path=None, backend_name=None):
+        def run():
+            try:
+                self.load(path, backend_name)
+            except Exception as e:
+                print(f"Error reloading model: {e}")
+        threading.Thread(target=run, name="model-reload", daemon=True).start()
+
+    def start_watching(self):
+        """Polls the model file and reloads it when its modification time changes."""
+        if self._watcher is not None or not self.watch_interval:
+            return
+
+        def watch():
+            while True:
+                time.sleep(self.watch_interval)
+                try:
+                    mtime = os.path.getmtime(self.path)
+                except OSError:
+                    continue
+                if mtime != self._watched_mtime and not self.loading:
+                    try:
+                        self.load()
+                    except Exception as e:
+                        print(f"Error reloading model: {e}")
+
+        self._watcher = threading.Thread(target=watch, name="model-watcher", daemon=True)
+        self._watcher.start()
+
+    def status(self):
+        current = self._current
+        return {
+            "version": current[0] if current else None,
+            "backend": self.backend_name,
+            "path": self.path,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "loading": self.loading,
+            "last_error": self.last_error,
+            "watching": self._watcher is not None,
+        }
+
+
+model_registry = ModelRegistry()
+
+
+class InferenceBatcher:
+    """
+    Gathers chunk tensors from concurrent requests into one model forward pass.
+    A batch is closed once it holds max_batch_size rows or the oldest request has
+    waited max_wait seconds; each caller gets back only its own slice of predictions.
+    Only requests pinned to the same backend share a batch.
+    """
+
+    def __init__(self, max_batch_size=INFERENCE_MAX_BATCH_SIZE, max_wait=INFERENCE_MAX_WAIT_SECONDS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._thread = None
+        self._batches = 0
+        self._requests = 0
+        self._rows = 0
+        self._max_batch_rows = 0
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+
+    def predict(self, X, backend):
+        """Blocks until backend's predictions for X are available."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((X, backend, future, time.monotonic()))
+        return future.result()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "batches": self._batches,
+                "requests": self._requests,
+                "rows": self._rows,
+                "mean_batch_rows": round(self._rows / self._batches, 2) if self._batches else 0,
+                "max_batch_rows": self._max_batch_rows,
+                "mean_requests_per_batch": round(self._requests / self._batches, 2) if self._batches else 0,
+                "mean_queue_wait_ms": round(1000 * self._total_wait / self._requests, 3) if self._requests else 0,
+                "max_queue_wait_ms": round(1000 * self._max_wait_seen, 3),
+                "queue_depth": self._queue.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": 1000 * self.max_wait,
+            }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="inference-batcher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        carried = None
+        while True:
+            first = carried if carried is not None else self._queue.get()
+            carried = None
+            batch = [first]
+            rows = len(first[0])
+            deadline = first[3] + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if rows + len(item[0]) > self.max_batch_size or item[1] is not first[1]:
+                    # Never split a request across forward passes or mix models in one;
+                    # it opens the next batch instead.
+                    carried = item
+                    break
+                batch.append(item)
+                rows += len(item[0])
+            self._run_batch(batch, rows)
+
+    def _run_batch(self, batch, rows):
+        started = time.monotonic()
+        waits = [started - enqueued for _, _, _, enqueued in batch]
+        try:
+            X = batch[0][0] if len(batch) == 1 else np.concatenate([X for X, _, _, _ in batch])
+            predictions = batch[0][1].predict(X)
+        except Exception as e:
+            for _, _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        with self._stats_lock:
+            self._batches += 1
+            self._requests += len(batch)
+            self._rows += rows
+            self._max_batch_rows = max(self._max_batch_rows, rows)
+            self._total_wait += sum(waits)
+            self._max_wait_seen = max(self._max_wait_seen, max(waits))
+
+        offset = 0
+        for X, _, future, _ in batch:
+            future.set_result(predictions[offset:offset + len(X)])
+            offset += len(X)
+
+
+inference_batcher = InferenceBatcher()
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire ttl seconds after being stored.
+    A load that started before an invalidate() of the same cache is not stored, so a
+    slow reader cannot put back a row that a concurrent write has just changed.
+    """
+
+    def __init__(self, maxsize=READ_CACHE_MAX_ENTRIES, ttl=READ_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value for key, or calls loader() -> (value, cacheable) on a
+        miss and stores value when cacheable is true.
+        """
+        hit, value, epoch = self._lookup(key)
+        if hit:
+            return value
+        value, cacheable = loader()
+        if cacheable:
+            self._store(key, value, epoch)
+        return value
+
+    async def get_or_load_async(self, key, loader):
+        """get_or_load() for a coroutine function loader."""
+        hit, value, epoch = self._lookup(key)
+        if hit:
+            return value
+        value, cacheable = await loader()
+        if cacheable:
+            self._store(key, value, epoch)
+        return value
+
+    def _lookup(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, entry[0], self._epoch
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return False, None, self._epoch
+
+    def _store(self, key, value, epoch):
+        with self._lock:
+            if epoch == self._epoch:
+                self._data[key] = (value, time.monotonic() + self.ttl)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._epoch += 1
+            self.invalidations += 1
+            self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "max_entries": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+profile_cache = TTLCache()
+user_status_cache = TTLCache()
+recording_stats_cache = TTLCache()
+
+
+class Metric:
+    """A labelled metric family rendered in the Prometheus text exposition format."""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labelnames)
+
+    @property
+    def family_name(self):
+        """Name used on the HELP and TYPE lines; text format 0.0.4 requires it to match the samples."""
+        return self.name
+
+    def render(self):
+        lines = [f"# HELP {self.family_name} {self.documentation}", f"# TYPE {self.family_name} {self.kind}"]
+        with self._lock:
+            samples = [(key, self._copy(value)) for key, value in sorted(self._values.items())]
+        for key, value in samples:
+            lines.extend(self._render_sample(dict(zip(self.labelnames, key)), value))
+        return lines
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    @property
+    def family_name(self):
+        return f"{self.name}_total"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_sample(self, labels, value):
+        return [f"{self.name}_total{format_labels(labels)} {value}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=METRICS_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    def _copy(self, value):
+        return list(value[0]), value[1], value[2]
+
+    def _render_sample(self, labels, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{format_labels(labels, le=format_number(bound))} {cumulative}")
+        lines.append(f"{self.name}_bucket{format_labels(labels, le='+Inf')} {count}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+def format_number(value):
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+def render_gauge(name, documentation, samples):
+    """Prometheus lines for a gauge whose [(labels, value)] samples are read at scrape time."""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+    lines.extend(f"{name}{format_labels(labels)} {value}" for labels, value in samples)
+    return lines
+
+
+# Metrics live in the process that serves /metrics; analysis jobs run in separate
+# worker processes and are only visible through their request/DB timings here.
+METRICS = []
+http_requests = Counter("snoring_http_requests", "HTTP requests served.", ("method", "endpoint", "status"))
+http_request_seconds = Histogram("snoring_http_request_seconds", "Time spent handling HTTP requests.", ("method", "endpoint"))
+request_payload_bytes = Histogram("snoring_request_payload_bytes", "Size of uploaded request bodies.", ("endpoint",), METRICS_SIZE_BUCKETS)
+audio_duration_seconds = Histogram("snoring_audio_duration_seconds", "Length of analysed recordings.", (), METRICS_DURATION_BUCKETS)
+stage_seconds = Histogram("snoring_stage_seconds", "Time spent in each analysis stage.", ("stage",))
+db_query_seconds = Histogram("snoring_db_query_seconds", "Time spent executing database queries.", ("query",))
+energy_gate_chunks = Counter("snoring_energy_gate_chunks", "Chunks passed to the CNN or skipped by the energy gate.", ("outcome",))
+
+# Stage breakdown of a request that sent TRACE_REQUEST_HEADER. A context variable rather
+# than flask.g so that asgi_app.py's executor threads can add to it as well.
+request_trace = contextvars.ContextVar("request_trace", default=None)
+
+def add_to_trace(name, seconds):
+    """Adds seconds to the current request's breakdown for the trace header."""
+    timings = request_trace.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+def server_timing_header(timings, elapsed):
+    entries = [f"{name};dur={1000 * seconds:.2f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={1000 * elapsed:.2f}")
+    return ", ".join(entries)
+
+def record_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+    add_to_trace(stage, seconds)
+
+@contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+def query_label(query):
+    """Low-cardinality label for a SQL string: the prepared statement name or the SQL verb."""
+    words = (query.decode() if isinstance(query, bytes) else str(query)).split(None, 2)
+    if not words:
+        return "unknown"
+    if words[0].upper() == "EXECUTE" and len(words) > 1:
+        return words[1].split("(")[0]
+    return words[0].lower()
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that records every execute() in db_query_seconds and the request trace."""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - started
+            label = query_label(query)
+            db_query_seconds.observe(elapsed, query=label)
+            add_to_trace(f"db.{label}", elapsed)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that remembers its server-side prepared statements and last use."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+        self.cursor_factory = TimedCursor
+
+
+# Fixed queries, prepared on first use by each pooled connection and run with EXECUTE.
+PREPARED_STATEMENTS = {
+    "insert_recording": """
+        INSERT INTO recordings (
+            user_uid, name, created_at, snoring_count, loudest_snore_db, file_url,duration_millis,apnea_events_count, snoring_absolute_timestamps, model_version
+        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+        RETURNING id
+    """,
+    "save_user_profile": """
+        INSERT INTO user_profiles (user_uid, first_name, last_name, sex, created_at, is_deleted) 
+        VALUES ($1, $2, $3, $4, $5, FALSE)
+        ON CONFLICT (user_uid) DO UPDATE SET
+            first_name = EXCLUDED.first_name,
+            last_name = EXCLUDED.last_name,
+            sex = EXCLUDED.sex
+        RETURNING user_uid
+    """,
+    "get_user_profile": """
+        SELECT user_uid, first_name, last_name, sex, created_at
+        FROM user_profiles
+        WHERE user_uid = $1
+    """,
+    "upsert_daily_stats": """
+        INSERT INTO recording_daily_stats AS s (
+            user_uid, day, recording_count, apnea_recording_count, apnea_events_sum, duration_millis_sum, max_snore_db, last_recorded_at
+        ) VALUES (
+            $1, DATE($2::timestamp), 1, CASE WHEN $3::integer IS NULL THEN 0 ELSE 1 END,
+            COALESCE($3::integer, 0), COALESCE($4::bigint, 0), $5, $2::timestamp
+        )
+        ON CONFLICT (user_uid, day) DO UPDATE SET
+            recording_count = s.recording_count + 1,
+            apnea_recording_count = s.apnea_recording_count + EXCLUDED.apnea_recording_count,
+            apnea_events_sum = s.apnea_events_sum + EXCLUDED.apnea_events_sum,
+            duration_millis_sum = s.duration_millis_sum + EXCLUDED.duration_millis_sum,
+            max_snore_db = GREATEST(s.max_snore_db, EXCLUDED.max_snore_db),
+            last_recorded_at = GREATEST(s.last_recorded_at, EXCLUDED.last_recorded_at)
+    """,
+    # Same figures as the old scan over recordings: AVG(apnea_events_count) ignored NULLs,
+    # hence apnea_recording_count as its denominator.
+    "get_recording_stats": """
+        SELECT 
+            COUNT(*) AS total_days,
+            COALESCE(SUM(duration_millis_sum) / 60000.0 / NULLIF(COUNT(*), 0), 0) AS avg_duration,
+            COALESCE(SUM(apnea_events_sum)::numeric / NULLIF(SUM(apnea_recording_count), 0), 0) AS avg_apnea_count, 
+            COALESCE(MAX(max_snore_db), 0) AS max_snore_db
+        FROM recording_daily_stats
+        WHERE user_uid = $1
+    """,
+    "get_all_user_stats": """
+        SELECT 
+            up.user_uid,
+            up.first_name,
+            up.last_name,
+            up.is_deleted,
+            up.created_at,
+            s.last_used,
+            COALESCE(s.days_used, 0) AS days_used,
+            COALESCE(s.total_duration_millis, 0) AS total_duration_millis
+        FROM user_profiles up
+        LEFT JOIN (
+            SELECT
+                user_uid,
+                MAX(last_recorded_at) AS last_used,
+                COUNT(*) AS days_used,
+                SUM(duration_millis_sum) AS total_duration_millis
+            FROM recording_daily_stats
+            GROUP BY user_uid
+        ) s ON s.user_uid = up.user_uid
+        ORDER BY s.last_used DESC NULLS LAST
+    """,
+    "update_user_status": """
+        UPDATE user_profiles 
+        SET is_deleted = $1
+        WHERE user_uid = $2
+        RETURNING user_uid
+    """,
+    "get_user_status": """
+        SELECT is_deleted
+        FROM user_profiles
+        WHERE user_uid = $1
+    """,
+    "upsert_envelope": """
+        INSERT INTO recording_envelopes (recording_id, chunk_seconds, loudness_db, snore_probability)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (recording_id) DO UPDATE SET
+            chunk_seconds = EXCLUDED.chunk_seconds,
+            loudness_db = EXCLUDED.loudness_db,
+            snore_probability = EXCLUDED.snore_probability
+    """,
+    "get_envelope": """
+        SELECT chunk_seconds, loudness_db, snore_probability
+        FROM recording_envelopes
+        WHERE recording_id = $1
+    """,
+    # Nothing is returned when another request already stored this content or key.
+    "insert_upload": """
+        INSERT INTO recording_uploads (recording_id, user_uid, content_hash, idempotency_key)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT DO NOTHING
+        RETURNING recording_id
+    """,
+    # A matching Idempotency-Key wins over a matching content hash.
+    "find_upload": """
+        SELECT r.id, r.snoring_count, r.loudest_snore_db, r.apnea_events_count, r.file_url,
+               r.created_at, r.snoring_absolute_timestamps, r.model_version
+        FROM recording_uploads u
+        JOIN recordings r ON r.id = u.recording_id
+        WHERE u.user_uid = $1 AND (u.content_hash = $2 OR u.idempotency_key = $3)
+        ORDER BY u.idempotency_key IS NOT DISTINCT FROM $3 DESC
+        LIMIT 1
+    """,
+}
+
+# Idempotent DDL, applied by "python app.py migrate-schema" before a deploy rather than at
+# startup: ALTER TABLE takes an ACCESS EXCLUSIVE lock that would queue behind open reads.
+SCHEMA_STATEMENTS = [
+    # Keyset pagination for /get-recordings walks (created_at, id) newest first per user.
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS recordings_user_created_id_idx ON recordings (user_uid, created_at DESC, id DESC)",
+    # Per-user, per-day rollup read by the stats endpoints; kept current by store_recording().
+    """
+    CREATE TABLE IF NOT EXISTS recording_daily_stats (
+        user_uid TEXT NOT NULL,
+        day DATE NOT NULL,
+        recording_count INTEGER NOT NULL DEFAULT 0,
+        apnea_recording_count INTEGER NOT NULL DEFAULT 0,
+        apnea_events_sum BIGINT NOT NULL DEFAULT 0,
+        duration_millis_sum BIGINT NOT NULL DEFAULT 0,
+        max_snore_db DOUBLE PRECISION,
+        last_recorded_at TIMESTAMP,
+        PRIMARY KEY (user_uid, day)
+    )
+    """,
+    # Which model produced each row's snore counts.
+    "ALTER TABLE recordings ADD COLUMN IF NOT EXISTS model_version TEXT",
+    # Timelines for /recording-envelope: int8 dB per second, uint8 snore probability x255 per chunk.
+    """
+    CREATE TABLE IF NOT EXISTS recording_envelopes (
+        recording_id INTEGER PRIMARY KEY REFERENCES recordings (id) ON DELETE CASCADE,
+        chunk_seconds REAL NOT NULL,
+        loudness_db BYTEA NOT NULL,
+        snore_probability BYTEA NOT NULL
+    )
+    """,
+    # SHA-256 of each stored upload's audio bytes and its Idempotency-Key, per user.
+    """
+    CREATE TABLE IF NOT EXISTS recording_uploads (
+        recording_id INTEGER PRIMARY KEY REFERENCES recordings (id) ON DELETE CASCADE,
+        user_uid TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
+        idempotency_key TEXT,
+        UNIQUE (user_uid, content_hash),
+        UNIQUE (user_uid, idempotency_key)
+    )
+    """,
+]
+
+def migrate_schema():
+    """Applies SCHEMA_STATEMENTS; CREATE INDEX CONCURRENTLY needs autocommit."""
+    with pooled_connection() as conn:
+        if not conn:
+            raise SystemExit("Failed to connect to the database.")
+        conn.autocommit = True
+        try:
+            cur = conn.cursor()
+            for statement in SCHEMA_STATEMENTS:
+                cur.execute(statement)
+            cur.close()
+        finally:
+            conn.autocommit = False
+    print(f"Applied {len(SCHEMA_STATEMENTS)} schema statements.")
 
-try:
-    model = load_model(MODEL_PATH)
-    print("Snoring detection model loaded successfully.")#ดักจับข้อผิดพลาดในการโหลดโมเดล
-except Exception as e:
-    print(f"Error loading model: {e}")
-    model = None
+def execute_prepared(cur, statement, params=()):
+    """Runs one of PREPARED_STATEMENTS by name, preparing it the first time this connection uses it."""
+    if statement not in cur.connection.prepared:
+        # PREPARE is not transactional, so a later rollback by the caller does not undo it.
+        cur.execute(f"PREPARE {statement} AS {PREPARED_STATEMENTS[statement]}")
+        cur.connection.prepared.add(statement)
+    if params:
+        cur.execute(f"EXECUTE {statement} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {statement}")
+
+
+class IdleKeepingPool(ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool keeps at most minconn idle connections and closes the rest on
+    putconn(); this one keeps up to maxconn, so overlapping requests reuse connections
+    (and their prepared statements) instead of reconnecting.
+    """
+
+    def _putconn(self, conn, key=None, close=False):
+        # Called with the pool lock held; minconn is only read here and in __init__.
+        minconn = self.minconn
+        self.minconn = self.maxconn
+        try:
+            super()._putconn(conn, key, close)
+        finally:
+            self.minconn = minconn
+
+
+db_pool = None
+db_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when it is exhausted, so callers
+# queue on this semaphore for a free slot first.
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONNECTIONS)
+
+def get_db_pool():
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = IdleKeepingPool(
+                DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS,
+                connection_factory=PooledConnection, **DB_CONFIG
+            )
+        return db_pool
+
+def connection_is_healthy(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.last_used < DB_HEALTHCHECK_IDLE_SECONDS:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
+    """
+    Checks a healthy connection out of the pool, or returns None when the database
+    is unreachable. Every connection must be handed back with release_db_connection().
+    """
+    if not db_pool_slots.acquire(timeout=DB_POOL_WAIT_SECONDS):
+        print("❌ Database connection failed: connection pool exhausted")
+        return None
+    conn = None
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
+        pool = get_db_pool()
+        conn = pool.getconn()
+        if not connection_is_healthy(conn):
+            pool.putconn(conn, close=True)
+            conn = None
+            conn = pool.getconn()
         return conn
     except Exception as e:
+        if conn is not None:
+            db_pool.putconn(conn, close=True)
+        db_pool_slots.release()
         print(f"❌ Database connection failed: {e}")#ดักจับข้อผิดพลาดการเชื่อมต่อserver
         return None
 
+def release_db_connection(conn):
+    """Returns a connection to the pool, rolling back anything left uncommitted."""
+    if conn is None:
+        return
+    try:
+        broken = bool(conn.closed)
+        if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        conn.last_used = time.monotonic()
+    except psycopg2.Error:
+        broken = True
+    try:
+        get_db_pool().putconn(conn, close=broken)
+    finally:
+        db_pool_slots.release()
+
+@contextmanager
+def pooled_connection():
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        release_db_connection(conn)
+
 
 
 def extract_features(y, sr, n_mels=128, n_fft=2048, hop_length=512, n_frames=128):
@@ -65,13 +961,529 @@ def extract_features(y, sr, n_mels=128, n_fft=2048, hop_length=512, n_frames=128
         
     return mels
 
+def extract_features_batch(chunks, sr, n_mels=128, n_fft=2048, hop_length=512, n_frames=128, batch_chunks=FEATURE_BATCH_CHUNKS):
+    """
+    Computes extract_features() for every row of a (n_chunks, chunk_samples) array.
+    Chunks are transformed FEATURE_BATCH_CHUNKS at a time so the STFT buffer stays small,
+    and the power_to_db reference / 80 dB floor are applied per chunk exactly as before.
+    """
+    out = np.empty((len(chunks), n_mels, n_frames), dtype=np.float32)
+    for start in range(0, len(chunks), batch_chunks):
+        mels = librosa.feature.melspectrogram(
+            y=chunks[start:start + batch_chunks],
+            sr=sr,
+            n_mels=n_mels,
+            n_fft=n_fft,
+            hop_length=hop_length,
+        )
+        ref = mels.max(axis=(-2, -1), keepdims=True)
+        mels = librosa.power_to_db(mels, ref=ref, top_db=None)
+        mels = np.maximum(mels, mels.max(axis=(-2, -1), keepdims=True) - 80.0)
+
+        frames = min(mels.shape[-1], n_frames)
+        out[start:start + len(mels), :, :frames] = mels[..., :frames]
+        out[start:start + len(mels), :, frames:] = 0
+    return out
+
+def frame_chunks(y, chunk_samples):
+    """Returns the complete chunk_samples-long chunks of y as a 2-D view (no copy)."""
+    n_chunks = len(y) // chunk_samples
+    return y[:n_chunks * chunk_samples].reshape(n_chunks, chunk_samples)
+
+def per_second_rms(y, sr, block_seconds=RMS_BLOCK_SECONDS):
+    """RMS of every 1-second window of y; the trailing partial window is included."""
+    n_full = len(y) // sr
+    seconds = frame_chunks(y, sr)
+    rms = np.empty(n_full + (1 if len(y) % sr else 0), dtype=y.dtype)
+    for start in range(0, n_full, block_seconds):
+        block = seconds[start:start + block_seconds]
+        rms[start:start + len(block)] = np.sqrt(np.mean(block ** 2, axis=1))
+    if len(y) % sr:
+        rms[-1] = np.sqrt(np.mean(y[n_full * sr:] ** 2))
+    return rms
+
+def scan_silence_runs(rms, carried_run=0, silence_threshold=SILENCE_THRESHOLD, min_silence_duration=MIN_SILENCE_DURATION):
+    """
+    Counts apnea events (runs of at least min_silence_duration silent seconds) in rms.
+    carried_run is the silent run left open by the previous block; the run still open
+    at the end of rms is returned so a scan can continue across block boundaries.
+    """
+    if len(rms) == 0:
+        return 0, carried_run
+    silent = rms < silence_threshold
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], silent, [False])).astype(np.int8)))
+    starts, run_lengths = edges[::2], edges[1::2] - edges[::2]
+    prior = np.zeros(len(run_lengths), dtype=np.int64)
+    if len(starts) and starts[0] == 0:
+        prior[0] = carried_run
+    events = int(np.count_nonzero((prior < min_silence_duration) & (prior + run_lengths >= min_silence_duration)))
+    trailing_run = int(prior[-1] + run_lengths[-1]) if silent[-1] else 0
+    return events, trailing_run
+
+def rms_to_snore_db(rms):
+    return 100 + 20 * np.log10(rms + 1e-6)
+
+
+class IncrementalAnalysis:
+    """
+    The analyze_audio() scan, fed with consecutive pieces of one 16 kHz signal.
+    Complete 4-second chunks are scored as soon as they arrive and the remainder is
+    carried into the next feed(), so chunk indices, 1-second RMS windows and silent
+    runs line up exactly with a single pass over the whole signal.
+    Chunks whose every second stays below energy_gate RMS are counted as not snoring
+    without being scored (probability 0 in the envelope).
+    """
+
+    def __init__(self, sr=TARGET_SR, model=None, energy_gate=ENERGY_GATE_RMS):
+        # The whole recording is scored by the model that was serving when it started.
+        model = model or model_registry.current()
+        if model is None:
+            raise RuntimeError("Model not loaded")
+        self.model_version, self.backend = model
+        self.sr = sr
+        self.chunk_samples = int(CHUNK_SECONDS * sr)
+        self.energy_gate = energy_gate
+        self.samples_analyzed = 0
+        self.chunks_analyzed = 0
+        self.chunks_skipped = 0
+        self.snoring_chunks = []
+        self.apnea_events_count = 0
+        self.silence_run = 0
+        self.loudest_snore_db = 0.0
+        self.loudness_envelope = []
+        self.probability_envelope = []
+        self._tail = np.zeros(0, dtype=np.float32)
+
+    def feed(self, y):
+        if len(self._tail):
+            y = np.concatenate((self._tail, y))
+        complete = len(y) // self.chunk_samples * self.chunk_samples
+        self._process(y[:complete])
+        self._tail = y[complete:].copy()
+
+    def finish(self):
+        """Scans the trailing partial chunk (RMS only, as before) and returns the result."""
+        self._process(self._tail)
+        self._tail = self._tail[:0]
+        return self.result()
+
+    def result(self):
+        return {
+            "snoring_count": len(self.snoring_chunks),
+            "snoring_times_seconds": [idx * CHUNK_SECONDS for idx in self.snoring_chunks],
+            "loudest_snore_db": float(self.loudest_snore_db),
+            "apnea_events_count": self.apnea_events_count,
+            "chunks_analyzed": self.chunks_analyzed,
+            "chunks_skipped": self.chunks_skipped,
+            "seconds_analyzed": self.samples_analyzed / self.sr,
+            "model_version": self.model_version,
+            "loudness_envelope": b"".join(block.tobytes() for block in self.loudness_envelope),
+            "probability_envelope": b"".join(block.tobytes() for block in self.probability_envelope),
+        }
+
+    def _process(self, y):
+        if len(y) == 0:
+            return
+        with stage_timer("rms_scan"):
+            rms = per_second_rms(y, self.sr)
+            events, self.silence_run = scan_silence_runs(rms, self.silence_run)
+            self.apnea_events_count += events
+            snore_db = rms_to_snore_db(rms)
+            self.loudest_snore_db = max(self.loudest_snore_db, snore_db.max())
+            self.loudness_envelope.append(np.clip(np.rint(snore_db), -128, 127).astype(np.int8))
+
+        chunks = frame_chunks(y, self.chunk_samples)
+        if len(chunks):
+            with stage_timer("energy_gate"):
+                scored = self._gate(chunks, rms)
+            probabilities = np.zeros(len(chunks), dtype=np.uint8)
+            if len(scored):
+                with stage_timer("features"):
+                    X_predict = np.expand_dims(extract_features_batch(chunks[scored], self.sr), axis=-1)
+                with stage_timer("predict"):
+                    predictions = inference_batcher.predict(X_predict, self.backend)
+                snoring = scored[predictions[:, 0] > 0.5] + self.chunks_analyzed
+                self.snoring_chunks.extend(int(idx) for idx in snoring)
+                probabilities[scored] = np.rint(np.clip(predictions[:, 0], 0, 1) * 255)
+            self.probability_envelope.append(probabilities)
+            skipped = len(chunks) - len(scored)
+            self.chunks_skipped += skipped
+            self.chunks_analyzed += len(chunks)
+            energy_gate_chunks.inc(len(scored), outcome="scored")
+            energy_gate_chunks.inc(skipped, outcome="skipped")
+
+        self.samples_analyzed += len(y)
+
+    def _gate(self, chunks, rms):
+        """Indices of the chunks loud enough to be scored by the CNN."""
+        if self.energy_gate <= 0 or self.chunk_samples % self.sr:
+            return np.arange(len(chunks))
+        seconds_per_chunk = self.chunk_samples // self.sr
+        loudest = rms[:len(chunks) * seconds_per_chunk].reshape(len(chunks), seconds_per_chunk).max(axis=1)
+        return np.flatnonzero(loudest >= self.energy_gate)
+
+
+def decode_audio(audio_bytes):
+    with stage_timer("decode"):
+        return AudioSegment.from_file(io.BytesIO(audio_bytes))
+
+PCM_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+def load_signal(audio_segment, sr=TARGET_SR):
+    """
+    Converts a decoded AudioSegment to a mono float32 signal at sr entirely in memory.
+    Scaling, channel averaging and soxr_hq resampling follow what librosa.load() does
+    with the exported WAV, so the result is the same without a temp-file round trip.
+    """
+    with stage_timer("convert"):
+        samples = np.frombuffer(audio_segment.raw_data, dtype=PCM_DTYPES[audio_segment.sample_width])
+        y = samples.astype(np.float32) / float(1 << (8 * audio_segment.sample_width - 1))
+        if audio_segment.channels > 1:
+            y = librosa.to_mono(y.reshape(-1, audio_segment.channels).T)
+    if audio_segment.frame_rate != sr:
+        with stage_timer("resample"):
+            y = librosa.resample(y, orig_sr=audio_segment.frame_rate, target_sr=sr)
+    return y
+
+def probe_audio(path):
+    """
+    (frame_rate, channels, bits, duration_seconds) of the first audio stream. bits is
+    the PCM width pydub would decode it to, rounded up to 16 or 32.
+    """
+    info = mediainfo_json(path)
+    stream = next(s for s in info["streams"] if s.get("codec_type") == "audio")
+    if stream.get("sample_fmt") == "fltp" and stream.get("codec_name") in ("mp3", "mp4", "aac", "webm", "ogg"):
+        bits = 16
+    else:
+        bits = int(stream.get("bits_per_sample") or 16)
+    try:
+        duration = float(stream.get("duration") or info.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        duration = 0.0
+    return int(stream["sample_rate"]), int(stream["channels"]), 16 if bits <= 16 else 32, duration
+
+def stream_signal(path, sr=TARGET_SR, block_seconds=STREAM_BLOCK_SECONDS):
+    """
+    Yields the mono float32 signal of the file at path, at sr, in blocks of about
+    block_seconds. Decoding runs in an ffmpeg pipe and resampling in a soxr stream, so
+    memory is bounded by the block size; the concatenated blocks are identical to
+    load_signal(decode_audio(...)) on the same file.
+    """
+    frame_rate, channels, bits, _ = probe_audio(path)
+    dtype = np.int16 if bits == 16 else np.int32
+    block_bytes = int(block_seconds * frame_rate) * channels * np.dtype(dtype).itemsize
+    resampler = soxr.ResampleStream(frame_rate, sr, 1, dtype="float32", quality="HQ") if frame_rate != sr else None
+    frames_in = samples_out = 0
+
+    process = subprocess.Popen(
+        [AudioSegment.converter, "-nostdin", "-loglevel", "error", "-i", path, "-vn", "-acodec", f"pcm_s{bits}le", "-f", f"s{bits}le", "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    try:
+        while True:
+            with stage_timer("decode"):
+                data = process.stdout.read(block_bytes)
+            last = len(data) < block_bytes
+            with stage_timer("convert"):
+                y = np.frombuffer(data, dtype=dtype).astype(np.float32) / float(1 << (bits - 1))
+                if channels > 1:
+                    y = librosa.to_mono(y.reshape(-1, channels).T)
+            frames_in += len(y)
+            if resampler is not None:
+                with stage_timer("resample"):
+                    y = resampler.resample_chunk(y, last=last)
+                if last:
+                    # librosa.resample() fixes the output length to ceil(n * ratio).
+                    expected = int(np.ceil(frames_in * (float(sr) / frame_rate)))
+                    y = y[:max(0, expected - samples_out)]
+                    if samples_out + len(y) < expected:
+                        y = np.pad(y, (0, expected - samples_out - len(y)))
+            samples_out += len(y)
+            if len(y):
+                yield y
+            if last:
+                break
+        errors = process.stderr.read()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to decode the upload: {errors.decode(errors='replace').strip()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+def export_recording(audio_segment, file_path, storage_format=STORAGE_FORMAT):
+    """Encodes a decoded recording in the storage codec."""
+    _, container, codec_args = STORAGE_FORMATS[storage_format]
+    audio_segment.export(file_path, format=container, parameters=codec_args or None)
+
+def transcode_recording(source_path, file_path, storage_format=STORAGE_FORMAT):
+    """Converts an audio file on disk to the storage codec with ffmpeg, without loading it into memory."""
+    _, container, codec_args = STORAGE_FORMATS[storage_format]
+    subprocess.run(
+        [AudioSegment.converter, "-nostdin", "-y", "-loglevel", "error", "-i", source_path, *codec_args, "-f", container, file_path],
+        check=True, capture_output=True
+    )
+
+def write_recording(user_uid, name, write_audio):
+    """
+    Writes the stored copy through write_audio(file_path) and returns its file name.
+    file_path carries the extension of STORAGE_FORMAT, so write_audio must encode in
+    that codec.
+    """
+    file_name = recording_file_name(user_uid, name)
+    with stage_timer("storage_write"):
+        write_audio(os.path.join(UPLOAD_FOLDER, file_name))
+    return file_name
+
+def store_recording(conn, user_uid, name, duration_millis, result, file_name, upload_key=None):
+    """
+    Inserts the recordings row for a file already written by write_recording() and
+    returns the JSON body sent back to the app.
+    upload_key is (content_hash, idempotency_key); when another process stored the
+    same upload first, this one is rolled back, its file removed and the earlier
+    result returned.
+    """
+    cur = conn.cursor()
+    file_path = os.path.join(UPLOAD_FOLDER, file_name)
+    file_url = f"/uploads/{file_name}"
+
+    current_time = datetime.now()
+    # เวลากรน = เวลาเริ่มต้น + เวลาชดเชย
+    snoring_absolute_timestamps = [current_time + timedelta(seconds=relative_sec) for relative_sec in result["snoring_times_seconds"]]
+
+    execute_prepared(cur, "insert_recording", (user_uid, name, current_time, result["snoring_count"], result["loudest_snore_db"], file_url, duration_millis, result["apnea_events_count"], snoring_absolute_timestamps, result["model_version"]))
+    new_id = cur.fetchone()[0]
+    execute_prepared(cur, "upsert_envelope", (new_id, CHUNK_SECONDS, result["loudness_envelope"], result["probability_envelope"]))
+    if upload_key and user_uid is not None:
+        execute_prepared(cur, "insert_upload", (new_id, user_uid, *upload_key))
+        if cur.fetchone() is None:
+            conn.rollback()
+            cur.close()
+            os.remove(file_path)
+            return find_upload(conn, user_uid, *upload_key)
+    if user_uid is not None:
+        execute_prepared(cur, "upsert_daily_stats", (user_uid, current_time, result["apnea_events_count"], duration_millis, result["loudest_snore_db"]))
+    conn.commit()
+    cur.close()
+    recording_stats_cache.invalidate(user_uid)
+    audio_duration_seconds.observe(result["seconds_analyzed"])
+    return recording_response(new_id, result, file_url, snoring_absolute_timestamps)
+
+def recording_file_name(user_uid, name):
+    # The uuid keeps two uploads stored in the same second from sharing a file, so the
+    # loser of a duplicate-upload race only ever removes its own copy.
+    return f"{user_uid}_{name}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex}{STORAGE_FORMATS[STORAGE_FORMAT][0]}"
+
+def recording_response(new_id, result, file_url, snoring_absolute_timestamps):
+    """The JSON body sent back to the app for a stored recording."""
+    return {
+        "message": "Analysis complete and data saved to DB",
+        "id": new_id,
+        "snoring_count": result["snoring_count"],
+        "loudest_snore_db": result["loudest_snore_db"],
+        "apnea_events_count": result["apnea_events_count"],
+        "file_url": file_url,
+        "created_at": datetime.now().isoformat(),
+        "snoring_absolute_timestamps": [t.isoformat() for t in snoring_absolute_timestamps],
+        "model_version": result["model_version"]
+    }
+
+def duplicate_upload_response(row):
+    """The /analyze-audio body for a recording that an earlier upload already stored."""
+    return {
+        "message": "Duplicate upload, returning the stored analysis",
+        "id": row[0],
+        "snoring_count": row[1],
+        "loudest_snore_db": row[2],
+        "apnea_events_count": row[3],
+        "file_url": row[4],
+        "created_at": row[5].isoformat(),
+        "snoring_absolute_timestamps": [t.isoformat() for t in row[6] or []],
+        "model_version": row[7],
+        "duplicate": True
+    }
+
+def find_upload(conn, user_uid, content_hash, idempotency_key):
+    """duplicate_upload_response() of the user's recording with this content or key, or None."""
+    cur = conn.cursor()
+    execute_prepared(cur, "find_upload", (user_uid, content_hash, idempotency_key))
+    row = cur.fetchone()
+    cur.close()
+    conn.commit()
+    return duplicate_upload_response(row) if row else None
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_SPOOL_BLOCK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+uploads_in_flight = {}
+uploads_in_flight_lock = threading.Lock()
+
+def deduplicated_upload(user_uid, content_hash, idempotency_key, analyse):
+    """
+    Returns the stored result when user_uid already uploaded this content or
+    Idempotency-Key, otherwise analyse(upload_key) -> (body, status). A retry that
+    arrives while the first attempt is still running in this process waits for it
+    rather than analysing the same audio twice; across processes the unique
+    constraints of recording_uploads settle the race in store_recording().
+    Anonymous uploads are never deduplicated.
+    """
+    if user_uid is None or content_hash is None:
+        return analyse(None)
+
+    keys = [(user_uid, "content", content_hash)] + ([(user_uid, "key", idempotency_key)] if idempotency_key else [])
+    while True:
+        with pooled_connection() as conn:
+            existing = find_upload(conn, user_uid, content_hash, idempotency_key) if conn else None
+        if existing is not None:
+            return existing, 200
+        with uploads_in_flight_lock:
+            running = next((uploads_in_flight[k] for k in keys if k in uploads_in_flight), None)
+            if running is None:
+                done = threading.Event()
+                for k in keys:
+                    uploads_in_flight[k] = done
+        if running is None:
+            break
+        running.wait(DUPLICATE_UPLOAD_WAIT_SECONDS)
+
+    try:
+        return analyse((content_hash, idempotency_key))
+    finally:
+        with uploads_in_flight_lock:
+            for k in keys:
+                if uploads_in_flight.get(k) is done:
+                    del uploads_in_flight[k]
+        done.set()
+
+def analyze_and_store(audio_bytes, user_uid, name, duration_millis, progress=None, upload_key=None):
+    """
+    Decodes the upload once and shares the decoded audio between analysis and the
+    stored WAV. The signal is analysed in ANALYSIS_BLOCK_SECONDS blocks, reporting
+    progress(fraction) after each one when a callback is given. Returns (body, status_code).
+    """
+    progress = progress or (lambda fraction: None)
+    audio_segment = decode_audio(audio_bytes)
+    y = load_signal(audio_segment)
+    progress(0.2)
+
+    analysis = IncrementalAnalysis()
+    block = int(ANALYSIS_BLOCK_SECONDS * analysis.sr)
+    for start in range(0, len(y), block):
+        analysis.feed(y[start:start + block])
+        progress(0.2 + 0.7 * min(1.0, (start + block) / len(y)))
+    result = analysis.finish()
+    return store_analysis(
+        result, user_uid, name, duration_millis,
+        lambda file_path: export_recording(audio_segment, file_path), progress, upload_key
+    )
+
+def analyze_file_and_store(audio_path, user_uid, name, duration_millis, progress=None, upload_key=None):
+    """
+    analyze_and_store() for an upload already on disk, decoded and analysed block by
+    block with stream_signal() so peak memory does not grow with the recording length.
+    The stored copy is transcoded from audio_path by ffmpeg.
+    """
+    progress = progress or (lambda fraction: None)
+    expected_seconds = probe_audio(audio_path)[3]
+    analysis = IncrementalAnalysis()
+    for y in stream_signal(audio_path, analysis.sr):
+        analysis.feed(y)
+        if expected_seconds:
+            progress(0.9 * min(1.0, analysis.samples_analyzed / analysis.sr / expected_seconds))
+    result = analysis.finish()
+    return store_analysis(
+        result, user_uid, name, duration_millis,
+        lambda file_path: transcode_recording(audio_path, file_path), progress, upload_key
+    )
+
+def store_analysis(result, user_uid, name, duration_millis, write_audio, progress=None, upload_key=None):
+    if result["chunks_analyzed"] == 0:
+        return {"error": "Analysis failed", "message": "Audio is too short for analysis."}, 400
+
+    # Encoded before a connection is checked out, so a full-night transcode does not
+    # hold one of the DB_POOL_MAX_CONNECTIONS slots.
+    file_name = write_recording(user_uid, name, write_audio)
+    file_path = os.path.join(UPLOAD_FOLDER, file_name)
+    response = None
+    try:
+        with pooled_connection() as conn:
+            if not conn:
+                return {"error": "Database error", "message": "Failed to connect to the database."}, 500
+            response = store_recording(conn, user_uid, name, duration_millis, result, file_name, upload_key)
+    finally:
+        if response is None and os.path.exists(file_path):
+            os.remove(file_path)
+    if progress:
+        progress(1.0)
+    return response, 200
+
+def use_streaming_analysis(size):
+    return size is not None and size >= STREAMING_ANALYSIS_MIN_BYTES
+
+def read_upload_request():
+    """
+    Reads (audio_bytes, user_uid, name, duration_millis) from a base64 JSON body,
+    a multipart form with an "audio" file, or a raw octet-stream body whose
+    metadata is in the query string.
+    """
+    if request.is_json:
+        data = request.json
+        audio_base64 = data.get("audio_data")
+        audio_bytes = base64.b64decode(audio_base64) if audio_base64 else b""
+        return audio_bytes, data.get("user_uid"), data.get("name", "Unnamed Recording"), data.get("duration_millis")
+
+    if request.files:
+        upload = request.files.get("audio")
+        audio_bytes = upload.read() if upload else b""
+        fields = request.form
+    else:
+        audio_bytes = request.get_data(cache=False)
+        fields = request.args
+    return audio_bytes, fields.get("user_uid"), fields.get("name", "Unnamed Recording"), fields.get("duration_millis", type=int)
+
+def spool_upload_request(audio_path):
+    """
+    read_upload_request() that writes the audio to audio_path instead of returning it,
+    copying multipart files and raw bodies in UPLOAD_SPOOL_BLOCK_BYTES pieces.
+    Returns (size, user_uid, name, duration_millis).
+    """
+    if request.is_json:
+        audio_bytes, user_uid, name, duration_millis = read_upload_request()
+        with open(audio_path, "wb") as f:
+            f.write(audio_bytes)
+        return len(audio_bytes), user_uid, name, duration_millis
+
+    if request.files:
+        upload = request.files.get("audio")
+        if upload:
+            upload.save(audio_path, buffer_size=UPLOAD_SPOOL_BLOCK_BYTES)
+        else:
+            open(audio_path, "wb").close()
+        fields = request.form
+    else:
+        with open(audio_path, "wb") as f:
+            while True:
+                block = request.stream.read(UPLOAD_SPOOL_BLOCK_BYTES)
+                if not block:
+                    break
+                f.write(block)
+        fields = request.args
+    return os.path.getsize(audio_path), fields.get("user_uid"), fields.get("name", "Unnamed Recording"), fields.get("duration_millis", type=int)
+
 @app.route("/analyze-audio", methods=["POST"])
 def analyze_audio():
-    """Receives base64 audio data, analyzes it for snoring, and saves results."""
-    # Assuming 'model' and 'extract_features' are defined elsewhere
-    # Assuming 'UPLOAD_FOLDER', 'get_db_connection', AudioSegment, librosa, np, 
-    # datetime, timedelta, os, io, and base64 are imported.
-    if model is None: 
+    """
+    Receives base64 audio data, analyzes it for snoring, and saves results.
+    A retry of an upload the user already stored (same audio bytes or Idempotency-Key
+    header) returns the stored result with "duplicate": true instead.
+    """
+    if model_registry.current() is None: 
         return jsonify({"error": "Model not loaded", "message": "The AI model failed to load on the server."}), 500
         
     try:
@@ -84,115 +1496,47 @@ def analyze_audio():
         if not audio_base64:
             return jsonify({"error": "Invalid input", "message": "Missing audio_data"}), 400
 
-        audio_bytes = base64.b64decode(audio_base64)
-        audio_io = io.BytesIO(audio_bytes)
-        
-        # Use a proper temporary file creation for safety
-        temp_wav_path = os.path.join(UPLOAD_FOLDER, f"temp_{os.getpid()}.wav")
-        audio_segment = AudioSegment.from_file(audio_io)
-        audio_segment.export(temp_wav_path, format="wav")
-        
-        y, sr = librosa.load(temp_wav_path, sr=16000)
-        os.remove(temp_wav_path)
-
-        chunk_size = 4.0  
-        chunk_samples = int(chunk_size * sr)
-        all_features_list = []
-
-        for i in range(0, len(y) - chunk_samples + 1, chunk_samples):
-            chunk = y[i:i + chunk_samples]
-            features = extract_features(chunk, sr)
-            all_features_list.append(features)
-
-        if not all_features_list:
-            return jsonify({"error": "Analysis failed", "message": "Audio is too short for analysis."}), 400
-
-        X_predict = np.stack([np.expand_dims(f, axis=-1) for f in all_features_list])
-        predictions = model.predict(X_predict, verbose=0)
-
-        snoring_count = 0
-        loudest_snore_db = 0.0
-        silence_duration = 0
-        apnea_events_count = 0
-        silence_threshold = 0.01      
-        min_silence_duration = 5 
-        snoring_times_seconds = []
-            
-        for i in range(0, len(y), sr):  
-            chunk = y[i:i + sr]
-            rms = np.sqrt(np.mean(chunk**2)) 
-
-            if rms < silence_threshold:
-                silence_duration += 1
-            else:
-                silence_duration = 0
-                
-            if silence_duration == min_silence_duration:
-                apnea_events_count += 1
-            
-            db_level = 20 * np.log10(rms + 1e-6) 
-            snore_db_scaled = 100 + db_level     
-            # loudest_snore_db will retain the NumPy float type here
-            loudest_snore_db = max(loudest_snore_db, snore_db_scaled) 
-
-        for idx, prob in enumerate(predictions):
-            if prob[0] > 0.5:
-                snoring_count += 1
-                relative_time = idx * 4.0 
-                snoring_times_seconds.append(relative_time)
-
-        # --- FIX: Convert NumPy float to standard Python float for DB insertion ---
-        # This resolves the "can't adapt type 'numpy.float32'" error.
-        if isinstance(loudest_snore_db, (np.float32, np.float64)):
-            loudest_snore_db_safe = float(loudest_snore_db)
-        else:
-            loudest_snore_db_safe = loudest_snore_db
+        with stage_timer("base64_decode"):
+            audio_bytes = base64.b64decode(audio_base64)
+        with stage_timer("content_hash"):
+            content_hash = hashlib.sha256(audio_bytes).hexdigest()
+        body, status = deduplicated_upload(
+            user_uid, content_hash, request.headers.get(IDEMPOTENCY_KEY_HEADER),
+            lambda upload_key: analyze_and_store(audio_bytes, user_uid, name, duration_millis, upload_key=upload_key)
+        )
+        return jsonify(body), status
 
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({"error": "Database error", "message": "Failed to connect to the database."}), 500
-        # The previous conn check should be sufficient, removing redundant check here.
-        # conn = get_db_connection()
-        # if not conn:
-        #     return jsonify({"error": "Database error", "message": "Failed to connect to the database."}), 500
-            
-        cur = conn.cursor()
-        file_name = f"{user_uid}_{name}_{datetime.now().strftime('%Y%m%d%H%M%S')}.wav"
-        file_path = os.path.join(UPLOAD_FOLDER, file_name)
-        audio_segment = AudioSegment.from_file(io.BytesIO(audio_bytes))
-        audio_segment.export(file_path, format="wav")
-        file_url = f"/uploads/{file_name}"
-
-        current_time = datetime.now()
-        snoring_absolute_timestamps = []
-        if snoring_times_seconds:
-            for relative_sec in snoring_times_seconds:
-                time_offset = timedelta(seconds=relative_sec)
-                # เวลากรน = เวลาเริ่มต้น + เวลาชดเชย
-                absolute_time = current_time + time_offset
-                snoring_absolute_timestamps.append(absolute_time)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Error during audio analysis: {e}")
+        return jsonify({"error": "Internal server error during analysis", "message": str(e)}), 500
 
-        cur.execute("""
-            INSERT INTO recordings (
-                user_uid, name, created_at, snoring_count, loudest_snore_db, file_url,duration_millis,apnea_events_count, snoring_absolute_timestamps
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id;
-        """, (user_uid, name, current_time, snoring_count, loudest_snore_db_safe, file_url, duration_millis, apnea_events_count, snoring_absolute_timestamps))
-        new_id = cur.fetchone()[0]
-        conn.commit()
-        cur.close()
-        conn.close()
+@app.route("/analyze-audio/binary", methods=["POST"])
+def analyze_audio_binary():
+    """
+    Same as /analyze-audio without the base64 JSON wrapper. Accepts either a multipart
+    form (file field "audio" plus name/user_uid/duration_millis fields) or a raw
+    application/octet-stream body with name/user_uid/duration_millis in the query string.
+    """
+    if model_registry.current() is None: 
+        return jsonify({"error": "Model not loaded", "message": "The AI model failed to load on the server."}), 500
 
-        return jsonify({
-            "message": "Analysis complete and data saved to DB",
-            "id": new_id,
-            "snoring_count": snoring_count,
-            "loudest_snore_db": loudest_snore_db_safe,
-            "apnea_events_count": apnea_events_count,
-            "file_url": file_url,
-            "created_at": datetime.now().isoformat(),
-            "snoring_absolute_timestamps": [t.isoformat() for t in snoring_absolute_timestamps]
-        })
+    try:
+        if use_streaming_analysis(request.content_length):
+            return analyze_spooled_upload()
+
+        audio_bytes, user_uid, name, duration_millis = read_upload_request()
+        if not audio_bytes:
+            return jsonify({"error": "Invalid input", "message": "Missing audio data"}), 400
+
+        with stage_timer("content_hash"):
+            content_hash = hashlib.sha256(audio_bytes).hexdigest()
+        body, status = deduplicated_upload(
+            user_uid, content_hash, request.headers.get(IDEMPOTENCY_KEY_HEADER),
+            lambda upload_key: analyze_and_store(audio_bytes, user_uid, name, duration_millis, upload_key=upload_key)
+        )
+        return jsonify(body), status
 
     except Exception as e:
         import traceback
@@ -200,6 +1544,450 @@ def analyze_audio():
         print(f"Error during audio analysis: {e}")
         return jsonify({"error": "Internal server error during analysis", "message": str(e)}), 500
 
+def analyze_spooled_upload():
+    """Spools a large /analyze-audio/binary body to disk and analyses it in streaming mode."""
+    fd, audio_path = tempfile.mkstemp(dir=UPLOAD_FOLDER, suffix=".upload")
+    os.close(fd)
+    try:
+        size, user_uid, name, duration_millis = spool_upload_request(audio_path)
+        if not size:
+            return jsonify({"error": "Invalid input", "message": "Missing audio data"}), 400
+
+        with stage_timer("content_hash"):
+            content_hash = file_sha256(audio_path)
+        body, status = deduplicated_upload(
+            user_uid, content_hash, request.headers.get(IDEMPOTENCY_KEY_HEADER),
+            lambda upload_key: analyze_file_and_store(audio_path, user_uid, name, duration_millis, upload_key=upload_key)
+        )
+        return jsonify(body), status
+    finally:
+        os.remove(audio_path)
+
+
+class UploadSession:
+    """One recording uploaded as ordered segments while the user is still recording."""
+
+    def __init__(self, session_id, user_uid, name):
+        self.session_id = session_id
+        self.user_uid = user_uid
+        self.name = name
+        self.lock = threading.Lock()
+        self.analysis = IncrementalAnalysis()
+        self.next_seq = 0
+        self.part_path = os.path.join(UPLOAD_FOLDER, f"session_{session_id}.part.wav")
+        self.last_activity = time.monotonic()
+        self._wav = None
+        self._wav_params = None
+
+    def append_audio(self, audio_segment):
+        """Appends the segment's PCM to the session's WAV, converted to the first segment's format."""
+        if self._wav is None:
+            self._wav_params = (audio_segment.frame_rate, audio_segment.channels, audio_segment.sample_width)
+            self._wav = wave.open(self.part_path, "wb")
+            self._wav.setframerate(self._wav_params[0])
+            self._wav.setnchannels(self._wav_params[1])
+            self._wav.setsampwidth(self._wav_params[2])
+        frame_rate, channels, sample_width = self._wav_params
+        audio_segment = audio_segment.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(sample_width)
+        self._wav.writeframes(audio_segment.raw_data)
+
+    def close_audio(self):
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+
+    def discard(self):
+        self.close_audio()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def status(self):
+        return {
+            "session_id": self.session_id,
+            "next_seq": self.next_seq,
+            "seconds_analyzed": round(self.analysis.samples_analyzed / self.analysis.sr, 3),
+            "snoring_count": len(self.analysis.snoring_chunks),
+            "apnea_events_count": self.analysis.apnea_events_count,
+        }
+
+
+UPLOAD_SESSION_IDLE_SECONDS = 2 * 60 * 60
+upload_sessions = {}
+upload_sessions_lock = threading.Lock()
+
+def expire_upload_sessions():
+    now = time.monotonic()
+    with upload_sessions_lock:
+        expired = [sid for sid, s in upload_sessions.items() if now - s.last_activity > UPLOAD_SESSION_IDLE_SECONDS]
+        expired_sessions = [upload_sessions.pop(sid) for sid in expired]
+    for session in expired_sessions:
+        with session.lock:
+            session.discard()
+
+def get_upload_session(session_id):
+    with upload_sessions_lock:
+        return upload_sessions.get(session_id)
+
+@app.route("/upload-sessions", methods=["POST"])
+def open_upload_session():
+    """Opens an upload session; segments are then appended in order and analysed as they arrive."""
+    if model_registry.current() is None: 
+        return jsonify({"error": "Model not loaded", "message": "The AI model failed to load on the server."}), 500
+
+    data = request.json or {}
+    user_uid = data.get("user_uid")
+    if not user_uid:
+        return jsonify({"error": "Invalid input", "message": "Missing user_uid"}), 400
+
+    expire_upload_sessions()
+    session = UploadSession(uuid.uuid4().hex, user_uid, data.get("name", "Unnamed Recording"))
+    with upload_sessions_lock:
+        upload_sessions[session.session_id] = session
+    return jsonify(session.status()), 201
+
+@app.route("/upload-sessions/<session_id>", methods=["GET"])
+def get_upload_session_status(session_id):
+    """Lets a client resume an interrupted upload from next_seq."""
+    session = get_upload_session(session_id)
+    if session is None:
+        return jsonify({"error": "Not Found", "message": "Upload session not found"}), 404
+    with session.lock:
+        return jsonify(session.status()), 200
+
+def append_session_segment(session, seq, audio_base64):
+    """Decodes, analyses and appends segment seq of a session; returns (body, status_code)."""
+    with session.lock:
+        session.last_activity = time.monotonic()
+        if seq < session.next_seq:
+            return dict(session.status(), duplicate=True), 200
+        if seq > session.next_seq:
+            return dict(session.status(), error="Out of order", message=f"Expected segment {session.next_seq}"), 409
+
+        audio_segment = decode_audio(base64.b64decode(audio_base64))
+        session.analysis.feed(load_signal(audio_segment))
+        session.append_audio(audio_segment)
+        session.next_seq += 1
+        return session.status(), 200
+
+@app.route("/upload-sessions/<session_id>/segments", methods=["POST"])
+def append_upload_segment(session_id):
+    """
+    Appends one base64 audio segment ({"seq": n, "audio_data": ...}) and analyses it.
+    A segment that was already received is acknowledged without being processed again.
+    """
+    session = get_upload_session(session_id)
+    if session is None:
+        return jsonify({"error": "Not Found", "message": "Upload session not found"}), 404
+
+    try:
+        data = request.json or {}
+        seq = data.get("seq")
+        audio_base64 = data.get("audio_data")
+        if seq is None or not audio_base64:
+            return jsonify({"error": "Invalid input", "message": "Missing seq or audio_data"}), 400
+
+        body, status = append_session_segment(session, seq, audio_base64)
+        return jsonify(body), status
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Error appending upload segment: {e}")
+        return jsonify({"error": "Internal server error during analysis", "message": str(e)}), 500
+
+@app.route("/upload-sessions/<session_id>/finalize", methods=["POST"])
+def finalize_upload_session(session_id):
+    """Merges the per-segment results, stores the recording and closes the session."""
+    session = get_upload_session(session_id)
+    if session is None:
+        return jsonify({"error": "Not Found", "message": "Upload session not found"}), 404
+
+    try:
+        data = request.json or {}
+        with session.lock:
+            result = session.analysis.finish()
+            session.close_audio()
+            response, status = store_analysis(
+                result, session.user_uid, session.name, data.get("duration_millis"),
+                lambda file_path: transcode_recording(session.part_path, file_path)
+            )
+            if status != 200:
+                return jsonify(response), status
+            os.remove(session.part_path)
+
+        with upload_sessions_lock:
+            upload_sessions.pop(session_id, None)
+        return jsonify(response)
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Error finalizing upload session: {e}")
+        return jsonify({"error": "Internal server error during analysis", "message": str(e)}), 500
+
+def job_db():
+    conn = sqlite3.connect(JOB_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def init_job_store():
+    with job_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS analysis_jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                progress REAL NOT NULL DEFAULT 0,
+                user_uid TEXT,
+                name TEXT,
+                duration_millis INTEGER,
+                audio_path TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                content_hash TEXT,
+                idempotency_key TEXT
+            )
+        """)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(analysis_jobs)")}
+        for column in ("content_hash", "idempotency_key"):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE analysis_jobs ADD COLUMN {column} TEXT")
+    conn.close()
+
+def update_job(job_id, **fields):
+    fields["updated_at"] = datetime.now().isoformat()
+    assignments = ", ".join(f"{column} = ?" for column in fields)
+    conn = job_db()
+    with conn:
+        conn.execute(f"UPDATE analysis_jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+    conn.close()
+
+def get_job(job_id):
+    conn = job_db()
+    row = conn.execute("SELECT * FROM analysis_jobs WHERE job_id = ?", (job_id,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def run_analysis_job(job_id):
+    """Runs inside a job worker process: analyses the stored upload and inserts the recording."""
+    job = get_job(job_id)
+    if job is None or job["status"] in ("done", "failed"):
+        return
+    update_job(job_id, status="running", progress=0.0)
+    try:
+        report_progress = lambda fraction: update_job(job_id, progress=round(fraction, 3))
+        if use_streaming_analysis(os.path.getsize(job["audio_path"])):
+            analyse = lambda upload_key: analyze_file_and_store(
+                job["audio_path"], job["user_uid"], job["name"], job["duration_millis"],
+                progress=report_progress, upload_key=upload_key
+            )
+        else:
+            with open(job["audio_path"], "rb") as f:
+                audio_bytes = f.read()
+            analyse = lambda upload_key: analyze_and_store(
+                audio_bytes, job["user_uid"], job["name"], job["duration_millis"],
+                progress=report_progress, upload_key=upload_key
+            )
+        body, status = deduplicated_upload(job["user_uid"], job["content_hash"], job["idempotency_key"], analyse)
+        if status == 200:
+            update_job(job_id, status="done", progress=1.0, result=json.dumps(body))
+        else:
+            update_job(job_id, status="failed", error=json.dumps(body))
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        update_job(job_id, status="failed", error=json.dumps({"error": "Internal server error during analysis", "message": str(e)}))
+    finally:
+        if os.path.exists(job["audio_path"]):
+            os.remove(job["audio_path"])
+
+def init_job_worker():
+    """Worker-process initializer: loads and warms this process's model and follows new versions."""
+    model_registry.current()
+    model_registry.start_watching()
+
+
+job_executor = None
+job_executor_lock = threading.Lock()
+
+def on_job_finished(job_id, future):
+    exc = future.exception()
+    if exc is None:
+        # The recording was inserted by a worker process, whose caches are not ours.
+        job = get_job(job_id)
+        if job is not None:
+            recording_stats_cache.invalidate(job["user_uid"])
+        return
+    # The worker died before it could record the outcome (e.g. it was killed).
+    update_job(job_id, status="failed", error=json.dumps({"error": "Worker failure", "message": str(exc)}))
+    if isinstance(exc, BrokenProcessPool):
+        global job_executor
+        with job_executor_lock:
+            job_executor = None
+
+def submit_job(job_id):
+    executor = get_job_executor()
+    future = executor.submit(run_analysis_job, job_id)
+    future.add_done_callback(lambda f: on_job_finished(job_id, f))
+
+def get_job_executor():
+    """
+    Starts the worker pool on first use. Workers are spawned (not forked) so each one
+    imports this module and loads its own copy of the model.
+    """
+    global job_executor
+    with job_executor_lock:
+        if job_executor is None:
+            init_job_store()
+            job_executor = ProcessPoolExecutor(
+                max_workers=JOB_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_job_worker,
+            )
+        return job_executor
+
+def resume_jobs():
+    """
+    Creates the job store and resubmits jobs left queued or running by a previous
+    server process. Called once at server start; the worker pool is only started
+    when there is something to resubmit.
+    """
+    init_job_store()
+    conn = job_db()
+    unfinished = [row["job_id"] for row in conn.execute(
+        "SELECT job_id FROM analysis_jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+    )]
+    conn.close()
+
+    for job_id in unfinished:
+        update_job(job_id, status="queued", progress=0.0)
+        submit_job(job_id)
+
+def enqueue_job(job_id, audio_path, user_uid, name, duration_millis, content_hash=None, idempotency_key=None):
+    """Records a spooled upload as a queued job and submits it; False when JOB_QUEUE_MAX jobs are active."""
+    now = datetime.now().isoformat()
+    with job_executor_lock:
+        conn = job_db()
+        active = conn.execute("SELECT COUNT(*) FROM analysis_jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+        if active >= JOB_QUEUE_MAX:
+            conn.close()
+            return False
+
+        with conn:
+            conn.execute("""
+                INSERT INTO analysis_jobs (
+                    job_id, status, progress, user_uid, name, duration_millis, audio_path, created_at, updated_at, content_hash, idempotency_key
+                )
+                VALUES (?, 'queued', 0, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (job_id, user_uid, name, duration_millis, audio_path, now, now, content_hash, idempotency_key))
+        conn.close()
+
+    submit_job(job_id)
+    return True
+
+def record_duplicate_job(job_id, audio_path, user_uid, name, duration_millis, body):
+    """Records an upload that was already stored as a finished job carrying the earlier result."""
+    now = datetime.now().isoformat()
+    conn = job_db()
+    with conn:
+        conn.execute("""
+            INSERT INTO analysis_jobs (job_id, status, progress, user_uid, name, duration_millis, audio_path, result, created_at, updated_at)
+            VALUES (?, 'done', 1, ?, ?, ?, ?, ?, ?, ?)
+        """, (job_id, user_uid, name, duration_millis, audio_path, json.dumps(body), now, now))
+    conn.close()
+
+def find_stored_upload(user_uid, content_hash, idempotency_key):
+    if user_uid is None:
+        return None
+    with pooled_connection() as conn:
+        return find_upload(conn, user_uid, content_hash, idempotency_key) if conn else None
+
+def job_status_body(job):
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "result": json.loads(job["result"]) if job["result"] else None,
+        "error": json.loads(job["error"]) if job["error"] else None,
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
+@app.route("/analyze-audio/jobs", methods=["POST"])
+def create_analysis_job():
+    """
+    Queues an upload (same body formats as /analyze-audio and /analyze-audio/binary)
+    for background analysis and returns its job id immediately. Returns 503 with
+    Retry-After when JOB_QUEUE_MAX jobs are already waiting or running. An upload the
+    user has already stored gets a job that is done at once with the earlier result.
+    """
+    if model_registry.current() is None: 
+        return jsonify({"error": "Model not loaded", "message": "The AI model failed to load on the server."}), 500
+
+    try:
+        get_job_executor()
+        job_id = uuid.uuid4().hex
+        audio_path = os.path.join(JOBS_FOLDER, f"{job_id}.upload")
+        size, user_uid, name, duration_millis = spool_upload_request(audio_path)
+        if not size:
+            os.remove(audio_path)
+            return jsonify({"error": "Invalid input", "message": "Missing audio data"}), 400
+
+        content_hash = file_sha256(audio_path)
+        idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        existing = find_stored_upload(user_uid, content_hash, idempotency_key)
+        if existing is not None:
+            os.remove(audio_path)
+            record_duplicate_job(job_id, audio_path, user_uid, name, duration_millis, existing)
+            return jsonify({"job_id": job_id, "status": "done", "status_url": f"/analyze-audio/jobs/{job_id}"}), 200
+
+        if not enqueue_job(job_id, audio_path, user_uid, name, duration_millis, content_hash, idempotency_key):
+            os.remove(audio_path)
+            response = jsonify({"error": "Busy", "message": "Too many analysis jobs in progress, please retry later."})
+            response.headers["Retry-After"] = "30"
+            return response, 503
+        return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/analyze-audio/jobs/{job_id}"}), 202
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Error queueing analysis job: {e}")
+        return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+@app.route("/analyze-audio/jobs/<job_id>", methods=["GET"])
+def get_analysis_job(job_id):
+    """Progress of a queued analysis job, plus the /analyze-audio result once it is done."""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Not Found", "message": "Job not found"}), 404
+
+    return jsonify(job_status_body(job)), 200
+
+@app.route("/admin/model", methods=["GET"])
+def get_model_status():
+    """Version and load state of the model currently serving requests."""
+    return jsonify(model_registry.status()), 200
+
+@app.route("/admin/reload-model", methods=["POST"])
+def reload_model():
+    """
+    Loads a new model in the background ({"path": ..., "backend": "keras"|"tflite"},
+    both optional) and swaps it in once warmed up; poll /admin/model for the result.
+    """
+    data = request.get_json(silent=True) or {}
+    backend_name = data.get("backend")
+    if backend_name is not None and backend_name not in INFERENCE_BACKENDS:
+        return jsonify({"error": "Invalid input", "message": f"Unknown backend: {backend_name}"}), 400
+    model_registry.reload_async(data.get("path"), backend_name)
+    return jsonify({"message": "Model reload started", **model_registry.status()}), 202
+
+@app.route("/inference-stats", methods=["GET"])
+def get_inference_stats():
+    """Batch-size and queue-wait statistics of the shared inference batcher."""
+    return jsonify(inference_batcher.stats()), 200
+
 @app.route("/save-user-profile", methods=["POST"])
 def save_user_profiles():
     """Receives user profiles data and saves it to the user_profile table."""
@@ -218,21 +2006,11 @@ def save_user_profiles():
             return jsonify({"error": "Invalid input", "message": "Missing required profile fields (uid, firstName, lastName, gender)."}), 400
 
         cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO user_profiles (user_uid, first_name, last_name, sex, created_at, is_deleted) 
-            VALUES (%s, %s, %s, %s, %s, FALSE)
-            ON CONFLICT (user_uid) DO UPDATE SET
-                first_name = EXCLUDED.first_name,
-                last_name = EXCLUDED.last_name,
-                sex = EXCLUDED.sex
-            RETURNING user_uid;
-            """,
-            (user_uid, first_name, last_name, sex, datetime.now()) 
-        )   
+        execute_prepared(cur, "save_user_profile", (user_uid, first_name, last_name, sex, datetime.now()))
         conn.commit()
         cur.close()
-        conn.close()
+        profile_cache.invalidate(user_uid)
+        user_status_cache.invalidate(user_uid)
 
         return jsonify({'message': 'User profile saved successfully', 'user_uid': user_uid}), 201
 
@@ -242,124 +2020,269 @@ def save_user_profiles():
         if conn: conn.rollback()
         print(f"Error saving user profile: {e}")
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
+    finally:
+        release_db_connection(conn)
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """
     Serves the static audio files from the UPLOAD_FOLDER directory.
     This route allows the mobile app to download/play the audio files.
+    Range requests are answered with 206 partial content so players can seek and stream.
     """
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    return send_from_directory(UPLOAD_FOLDER, filename, conditional=True)
 
 @app.route("/get-user-profile/<user_uid>", methods=["GET"])
 def get_user_profile(user_uid):
     """ดึงข้อมูลโปรไฟล์ผู้ใช้จากตาราง user_profiles ตาม user_uid"""
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database error", "message": "Failed to connect to the database."}), 500
+    def load_profile():
+        conn = get_db_connection()
+        if not conn:
+            return ({"error": "Database error", "message": "Failed to connect to the database."}, 500), False
+        try:
+            cur = conn.cursor()
+            execute_prepared(cur, "get_user_profile", (user_uid,))
+            row = cur.fetchone()
+            cur.close()
 
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT user_uid, first_name, last_name, sex, created_at
-            FROM user_profiles
-            WHERE user_uid = %s;
-        """, (user_uid,))
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
+            if not row:
+                return ({"error": "Not Found", "message": "User profile not found"}, 404), False
+            
+            return ({
+                "user_uid": row[0],
+                "first_name": row[1],
+                "last_name": row[2],
+                "sex": row[3],
+                "created_at": row[4].isoformat() if row[4] else None
+            }, 200), True
 
-        if not row:
-            return jsonify({"error": "Not Found", "message": "User profile not found"}), 404
-        
-        return jsonify({
-            "user_uid": row[0],
-            "first_name": row[1],
-            "last_name": row[2],
-            "sex": row[3],
-            "created_at": row[4].isoformat() if row[4] else None
-        }), 200
+        except Exception as e:
+            print(f"Error fetching user profile: {e}")
+            if conn: conn.rollback()
+            return ({"error": "Internal server error", "message": str(e)}, 500), False
+        finally:
+            release_db_connection(conn)
 
-    except Exception as e:
-        print(f"Error fetching user profile: {e}")
-        if conn: conn.rollback()
-        return jsonify({"error": "Internal server error", "message": str(e)}), 500
+    body, status = profile_cache.get_or_load(user_uid, load_profile)
+    return jsonify(body), status
     
 @app.route('/get-recording-stats/<uid>', methods=['GET'])
 def get_recording_stats(uid):
     print("📩 Received UID:", repr(uid))
+    def load_stats():
+        conn = get_db_connection()
+        if not conn:
+            return ({"error": "Database error", "message": "Failed to connect to the database."}, 500), False
+        try:
+            cur = conn.cursor()
+            execute_prepared(cur, "get_recording_stats", (uid,))
+            
+            row = cur.fetchone()
+            cur.close()
+
+            return ({
+                'total_days': row[0] or 0,
+                'avg_duration': round(row[1] or 0, 2),
+                'avg_apnea_count': round(row[2] or 0, 2),  
+                'max_snore_db': round(row[3] or 0, 2)      
+            }, 200), True
+
+        except Exception as e:
+            print(f" Error in /get-recording-stats: {e}")
+            return ({"error": "Internal server error", "message": str(e)}, 500), False
+        finally:
+            release_db_connection(conn)
+
+    body, status = recording_stats_cache.get_or_load(uid, load_stats)
+    return jsonify(body), status
+
+# Public field name -> (column, JSON formatter) for /get-recordings.
+RECORDING_FIELDS = {
+    "id": ("id", lambda v: v),
+    "name": ("name", lambda v: v),
+    "snoring_count": ("snoring_count", lambda v: v),
+    "loudest_snore_db": ("loudest_snore_db", lambda v: v),
+    "file_url": ("file_url", lambda v: v),
+    "created_at": ("created_at", lambda v: v.isoformat()),
+    "duration_millis": ("duration_millis", lambda v: v),
+    "apnea_events_count": ("apnea_events_count", lambda v: v),
+    "snoring_absolute_timestamps": ("snoring_absolute_timestamps", lambda v: [t.isoformat() for t in v] if v else []),
+    "model_version": ("model_version", lambda v: v),
+}
+
+def encode_recordings_cursor(created_at, recording_id):
+    raw = json.dumps([created_at.isoformat(), recording_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_recordings_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    created_at, recording_id = json.loads(raw)
+    return datetime.fromisoformat(created_at), int(recording_id)
+
+def recording_rows_query(fields, keyset):
+    # id and created_at always come first: they are the sort key and the cursor.
+    columns = ["id", "created_at"] + [RECORDING_FIELDS[f][0] for f in fields]
+    sql = f"SELECT {', '.join(columns)} FROM recordings WHERE user_uid = %s"
+    if keyset:
+        sql += " AND (created_at, id) < (%s, %s)"
+    return sql + " ORDER BY created_at DESC, id DESC"
+
+def recording_row_to_json(fields, row):
+    return {field: RECORDING_FIELDS[field][1](value) for field, value in zip(fields, row[2:])}
+
+@app.route("/get-recordings/<user_uid>", methods=["GET"])
+def get_recordings(user_uid):
+    """
+    Retrieve recorded audio analysis results for a specific user, newest first.
+
+    Query parameters:
+      fields  comma-separated subset of RECORDING_FIELDS, e.g. omit snoring_absolute_timestamps
+      limit   page size; with limit or cursor the reply is {"recordings": [...], "next_cursor": ...}
+      cursor  next_cursor from the previous page
+
+    Without limit/cursor the full list is returned as before, streamed from a server-side cursor.
+    """
+    fields = request.args.get("fields")
+    fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(RECORDING_FIELDS)
+    unknown = [f for f in fields if f not in RECORDING_FIELDS]
+    if unknown:
+        return jsonify({"error": "Invalid input", "message": f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    paginated = "limit" in request.args or "cursor" in request.args
+    try:
+        limit = min(max(request.args.get("limit", RECORDINGS_PAGE_SIZE, type=int), 1), RECORDINGS_MAX_PAGE_SIZE)
+        keyset = decode_recordings_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid input", "message": "Invalid limit or cursor"}), 400
+
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database error", "message": "Failed to connect to the database."}), 500
 
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT 
-                COUNT(DISTINCT DATE(created_at)) AS total_days,
-                COALESCE(SUM(duration_millis) / 60000.0 / NULLIF(COUNT(DISTINCT DATE(created_at)), 0), 0) AS avg_duration,
-                COALESCE(AVG(apnea_events_count), 0) AS avg_apnea_count, 
-                COALESCE(MAX(loudest_snore_db), 0) AS max_snore_db
-            FROM recordings
-            WHERE user_uid = %s;
-        """, (uid,))
-        
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
+    params = (user_uid,) + (keyset or ())
+    if paginated:
+        try:
+            cur = conn.cursor()
+            cur.execute(recording_rows_query(fields, keyset) + " LIMIT %s", params + (limit + 1,))
+            rows = cur.fetchall()
+            cur.close()
 
-        return jsonify({
-            'total_days': row[0] or 0,
-            'avg_duration': round(row[1] or 0, 2),
-            'avg_apnea_count': round(row[2] or 0, 2),  
-            'max_snore_db': round(row[3] or 0, 2)      
-        })
+            next_cursor = encode_recordings_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+            return jsonify({
+                "recordings": [recording_row_to_json(fields, r) for r in rows[:limit]],
+                "next_cursor": next_cursor
+            })
+        except Exception as e:
+            print(f"Error fetching recordings: {e}")
+            return jsonify({"error": "Internal server error", "message": "Failed to fetch recordings."}), 500
+        finally:
+            release_db_connection(conn)
 
-    except Exception as e:
-        print(f" Error in /get-recording-stats: {e}")
-        if conn:
-            conn.close()
-        return jsonify({"error": "Internal server error", "message": str(e)}), 500
+    released = []
 
-@app.route("/get-recordings/<user_uid>", methods=["GET"])
-def get_recordings(user_uid):
-    """Retrieve all recorded audio analysis results for a specific user."""
+    def release_once():
+        if not released:
+            released.append(True)
+            release_db_connection(conn)
+
+    def generate():
+        # ดึงทีละชุดจาก server-side cursor แล้วส่งออกทันที ไม่ต้องเก็บทั้งหมดไว้ในหน่วยความจำ
+        try:
+            cur = conn.cursor(name=f"recordings_{uuid.uuid4().hex}")
+            cur.itersize = RECORDINGS_STREAM_ITERSIZE
+            cur.execute(recording_rows_query(fields, None), params)
+            yield "["
+            for i, r in enumerate(cur):
+                yield ("," if i else "") + app.json.dumps(recording_row_to_json(fields, r))
+            yield "]"
+            cur.close()
+        except Exception as e:
+            print(f"Error streaming recordings: {e}")
+            raise
+        finally:
+            release_once()
+
+    response = Response(generate(), mimetype="application/json")
+    # Also covers a client that disconnects before the generator has started.
+    response.call_on_close(release_once)
+    return response
+    
+def downsample_envelope(values, points):
+    """Maximum over points near-equal buckets of values, so short snores stay visible."""
+    if len(values) <= points:
+        return values
+    edges = (np.arange(points) * len(values)) // points
+    return np.maximum.reduceat(values, edges)
+
+def envelope_response(recording_id, row, points, binary):
+    """
+    (body, mimetype, headers) for a recording_envelopes row. The JSON body holds dB and
+    0-1 probabilities; the binary body is the int8 dB bytes followed by the uint8
+    probability bytes, with the counts and spacing in X-Envelope-* headers.
+    """
+    chunk_seconds, loudness_db, snore_probability = row
+    loudness = np.frombuffer(loudness_db, dtype=np.int8)
+    probability = np.frombuffer(snore_probability, dtype=np.uint8)
+    loudness_points = downsample_envelope(loudness, points)
+    probability_points = downsample_envelope(probability, points)
+    loudness_step = len(loudness) / len(loudness_points) if len(loudness_points) else 1.0
+    probability_step = chunk_seconds * len(probability) / len(probability_points) if len(probability_points) else chunk_seconds
+
+    if binary:
+        return loudness_points.tobytes() + probability_points.tobytes(), "application/octet-stream", {
+            "X-Envelope-Loudness-Points": str(len(loudness_points)),
+            "X-Envelope-Loudness-Seconds-Per-Point": f"{loudness_step:g}",
+            "X-Envelope-Probability-Points": str(len(probability_points)),
+            "X-Envelope-Probability-Seconds-Per-Point": f"{probability_step:g}",
+        }
+    return json.dumps({
+        "recording_id": recording_id,
+        "loudness_db": loudness_points.tolist(),
+        "loudness_seconds_per_point": loudness_step,
+        "snore_probability": np.round(probability_points / 255, 3).tolist(),
+        "probability_seconds_per_point": probability_step,
+    }), "application/json", {}
+
+def envelope_request_args(args):
+    """(points, binary) from the ?points= and ?format= query parameters; raises ValueError."""
+    points = args.get("points", ENVELOPE_DEFAULT_POINTS, type=int)
+    if not 1 <= points <= ENVELOPE_MAX_POINTS:
+        raise ValueError(f"points must be between 1 and {ENVELOPE_MAX_POINTS}")
+    fmt = args.get("format", "json")
+    if fmt not in ("json", "binary"):
+        raise ValueError("format must be json or binary")
+    return points, fmt == "binary"
+
+@app.route("/recording-envelope/<int:recording_id>", methods=["GET"])
+def get_recording_envelope(recording_id):
+    """
+    Per-second loudness and per-chunk snore probability timeline of a recording,
+    downsampled to at most ?points= values each (max per bucket).
+    ?format=binary returns the raw int8/uint8 arrays instead of JSON.
+    """
     try:
-        conn = get_db_connection()
+        points, binary = envelope_request_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": "Invalid input", "message": str(e)}), 400
+
+    with pooled_connection() as conn:
         if not conn:
             return jsonify({"error": "Database error", "message": "Failed to connect to the database."}), 500
-            
-        cur = conn.cursor()
-        cur.execute("""
-            -- ดึงข้อมูล apnea_events_count และปรับตำแหน่งของ snoring_absolute_timestamps
-            SELECT id, name, snoring_count, loudest_snore_db, file_url, created_at,duration_millis, apnea_events_count, snoring_absolute_timestamps 
-            FROM recordings
-            WHERE user_uid = %s
-            ORDER BY created_at DESC;
-        """, (user_uid,))
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
+        try:
+            cur = conn.cursor()
+            execute_prepared(cur, "get_envelope", (recording_id,))
+            row = cur.fetchone()
+            cur.close()
+        except Exception as e:
+            print(f"Error fetching recording envelope: {e}")
+            conn.rollback()
+            return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+    if not row:
+        return jsonify({"error": "Not Found", "message": "No envelope stored for this recording"}), 404
+    body, mimetype, headers = envelope_response(recording_id, row, points, binary)
+    return Response(body, mimetype=mimetype, headers=headers)
 
-        results = [
-            {
-                "id": r[0],
-                "name": r[1],
-                "snoring_count": r[2],
-                "loudest_snore_db": r[3],
-                "file_url": r[4],
-                "created_at": r[5].isoformat(),
-                "duration_millis": r[6],
-                "apnea_events_count": r[7],
-                "snoring_absolute_timestamps": [t.isoformat() for t in r[8]] if r[8] else [] 
-            }
-            for r in rows
-        ]
-        return jsonify(results)
-    except Exception as e:
-        print(f"Error fetching recordings: {e}")
-        return jsonify({"error": "Internal server error", "message": "Failed to fetch recordings."}), 500
-    
 @app.route("/admin/get-all-user-stats", methods=["GET"])
 def get_all_user_stats():
     """
@@ -372,26 +2295,9 @@ def get_all_user_stats():
 
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT 
-                up.user_uid,
-                up.first_name,
-                up.last_name,
-                up.is_deleted,
-                up.created_at,
-                MAX(r.created_at) AS last_used,
-                COUNT(DISTINCT DATE(r.created_at)) AS days_used,
-                COALESCE(SUM(r.duration_millis), 0) AS total_duration_millis
-                
-                    
-            FROM user_profiles up
-            LEFT JOIN recordings r ON up.user_uid = r.user_uid
-            GROUP BY up.user_uid, up.first_name, up.last_name, up.is_deleted, up.created_at
-            ORDER BY last_used DESC NULLS LAST;
-        """)
+        execute_prepared(cur, "get_all_user_stats")
         rows = cur.fetchall()
         cur.close()
-        conn.close()
 
         results = [
             {
@@ -417,6 +2323,8 @@ def get_all_user_stats():
         if conn: conn.rollback()
         print(f"Error fetching admin user stats: {e}")
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
+    finally:
+        release_db_connection(conn)
 
 @app.route('/admin/user-profile/<uid>', methods=['PUT'])
 def update_user_profile(uid):
@@ -436,17 +2344,13 @@ def update_user_profile(uid):
         is_deleted = data['is_deleted']
 
         cur = conn.cursor()
-        cur.execute("""
-            UPDATE user_profiles 
-            SET is_deleted = %s
-            WHERE user_uid = %s
-            RETURNING user_uid;
-        """, (is_deleted, uid))
+        execute_prepared(cur, "update_user_status", (is_deleted, uid))
 
         updated = cur.fetchone()
         conn.commit()
         cur.close()
-        conn.close()
+        user_status_cache.invalidate(uid)
+        profile_cache.invalidate(uid)
 
         if not updated:
             return jsonify({"message": f"User {uid} not found"}), 404
@@ -462,37 +2366,172 @@ def update_user_profile(uid):
         traceback.print_exc()
         if conn: conn.rollback()
         return jsonify({"message": f"Error updating user status: {str(e)}"}), 500
+    finally:
+        release_db_connection(conn)
 
 @app.route("/user-status/<uid>", methods=["GET"])
 def get_user_status(uid):
     """
     ใช้สำหรับให้ฝั่ง Mobile App ตรวจสอบสถานะบัญชี (ถูกระงับหรือไม่)
     """
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"message": "Database connection failed"}), 500
+    def load_status():
+        conn = get_db_connection()
+        if not conn:
+            return ({"message": "Database connection failed"}, 500), False
+        try:
+            cur = conn.cursor()
+            execute_prepared(cur, "get_user_status", (uid,))
+            row = cur.fetchone()
+            cur.close()
 
-    try:
+            if not row:
+                return ({"message": "User not found", "isDeleted": False}, 404), False
+
+            return ({"isDeleted": row[0]}, 200), True
+
+        except Exception as e:
+            print("Error fetching user status:", e)
+            return ({"message": str(e)}, 500), False
+        finally:
+            release_db_connection(conn)
+
+    body, status = user_status_cache.get_or_load(uid, load_status)
+    return jsonify(body), status
+
+@app.route("/cache-stats", methods=["GET"])
+def get_cache_stats():
+    """Hit/miss counters of the in-process read caches."""
+    return jsonify({
+        "user_profile": profile_cache.stats(),
+        "user_status": user_status_cache.stats(),
+        "recording_stats": recording_stats_cache.stats(),
+    }), 200
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    request_trace.set(OrderedDict() if request.headers.get(TRACE_REQUEST_HEADER) else None)
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    elapsed = time.perf_counter() - g.get("request_started", time.perf_counter())
+    http_requests.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+    http_request_seconds.observe(elapsed, method=request.method, endpoint=endpoint)
+    if request.content_length:
+        request_payload_bytes.observe(request.content_length, endpoint=endpoint)
+    timings = request_trace.get()
+    if timings is not None:
+        response.headers["Server-Timing"] = server_timing_header(timings, elapsed)
+        request_trace.set(None)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """All counters and histograms plus batcher, cache and model state in Prometheus text format."""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    batcher = inference_batcher.stats()
+    for key in ("batches", "requests", "rows", "queue_depth", "mean_batch_rows", "mean_queue_wait_ms", "max_queue_wait_ms"):
+        lines.extend(render_gauge(f"snoring_inference_batcher_{key}", f"Inference batcher {key.replace('_', ' ')}.", [({}, batcher[key])]))
+
+    caches = {"user_profile": profile_cache, "user_status": user_status_cache, "recording_stats": recording_stats_cache}
+    cache_stats = {name: cache.stats() for name, cache in caches.items()}
+    for key in ("entries", "hits", "misses", "evictions", "invalidations"):
+        lines.extend(render_gauge(
+            f"snoring_read_cache_{key}", f"Read cache {key}.",
+            [({"cache": name}, stats[key]) for name, stats in cache_stats.items()]
+        ))
+
+    model = model_registry.status()
+    lines.extend(render_gauge(
+        "snoring_model_info", "Model currently serving requests.",
+        [({"version": model["version"] or "", "backend": model["backend"]}, 1 if model["version"] else 0)]
+    ))
+    lines.extend(render_gauge("snoring_upload_sessions", "Open upload sessions.", [({}, len(upload_sessions))]))
+    return "\n".join(lines) + "\n"
+
+def backfill_daily_stats():
+    """Rebuilds recording_daily_stats from the recordings table."""
+    with pooled_connection() as conn:
+        if not conn:
+            raise SystemExit("Failed to connect to the database.")
         cur = conn.cursor()
+        # SHARE mode blocks new recordings until the rebuild commits, so none are missed.
+        cur.execute("LOCK TABLE recordings IN SHARE MODE")
+        cur.execute("DELETE FROM recording_daily_stats")
         cur.execute("""
-            SELECT is_deleted
-            FROM user_profiles
-            WHERE user_uid = %s;
-        """, (uid,))
-        row = cur.fetchone()
+            INSERT INTO recording_daily_stats (
+                user_uid, day, recording_count, apnea_recording_count, apnea_events_sum, duration_millis_sum, max_snore_db, last_recorded_at
+            )
+            SELECT
+                user_uid,
+                DATE(created_at),
+                COUNT(*),
+                COUNT(apnea_events_count),
+                COALESCE(SUM(apnea_events_count), 0),
+                COALESCE(SUM(duration_millis), 0),
+                MAX(loudest_snore_db),
+                MAX(created_at)
+            FROM recordings
+            WHERE user_uid IS NOT NULL
+            GROUP BY user_uid, DATE(created_at);
+        """)
+        rows = cur.rowcount
+        conn.commit()
         cur.close()
-        conn.close()
-
-        if not row:
-            return jsonify({"message": "User not found", "isDeleted": False}), 404
-
-        return jsonify({"isDeleted": row[0]}), 200
+    print(f"Backfilled {rows} daily rollup rows.")
 
-    except Exception as e:
-        print("Error fetching user status:", e)
-        if conn:
-            conn.close()
-        return jsonify({"message": str(e)}), 500
+def migrate_storage(storage_format=STORAGE_FORMAT):
+    """Converts stored WAV recordings to storage_format and repoints their file_url."""
+    extension = STORAGE_FORMATS[storage_format][0]
+    with pooled_connection() as conn:
+        if not conn:
+            raise SystemExit("Failed to connect to the database.")
+        cur = conn.cursor()
+        cur.execute("SELECT id, file_url FROM recordings WHERE file_url LIKE %s ORDER BY id", ("%.wav",))
+        rows = cur.fetchall()
+        converted = 0
+        for recording_id, file_url in rows:
+            wav_path = os.path.join(UPLOAD_FOLDER, os.path.basename(file_url))
+            if not os.path.exists(wav_path):
+                print(f"Skipping recording {recording_id}: {wav_path} not found")
+                continue
+            file_name = os.path.splitext(os.path.basename(file_url))[0] + extension
+            try:
+                transcode_recording(wav_path, os.path.join(UPLOAD_FOLDER, file_name), storage_format)
+            except subprocess.CalledProcessError as e:
+                print(f"Skipping recording {recording_id}: {e.stderr.decode(errors='replace').strip()}")
+                continue
+            cur.execute("UPDATE recordings SET file_url = %s WHERE id = %s", (f"/uploads/{file_name}", recording_id))
+            conn.commit()
+            # The WAV is only removed once the row points at the converted file.
+            os.remove(wav_path)
+            converted += 1
+        cur.close()
+    print(f"Converted {converted} of {len(rows)} WAV recordings to {storage_format}.")
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Snoring analysis server")
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "migrate-schema", "backfill-daily-stats", "migrate-storage"])
+    args = parser.parse_args()
+
+    if args.command == "migrate-schema":
+        migrate_schema()
+    elif args.command == "backfill-daily-stats":
+        backfill_daily_stats()
+    elif args.command == "migrate-storage":
+        migrate_storage()
+    else:
+        model_registry.current()
+        model_registry.start_watching()
+        # debug=True also runs this block in the reloader's parent process, which never
+        # serves requests; only the serving child resubmits jobs.
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            resume_jobs()
+        app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
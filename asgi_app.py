@@ -0,0 +1,822 @@
+"""
+Async (ASGI) serving mode for the snoring analysis API.
+
+    hypercorn asgi_app:app --bind 0.0.0.0:5000
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+
+Same routes and JSON bodies as app.py, on Quart with an asyncpg pool and aiofiles
+for upload and recording writes. Decoding, feature extraction, inference and
+encoding run on ANALYSIS_THREADS executor threads; concurrent uploads still share
+forward passes through app.inference_batcher. Cheap blocking calls (the SQLite
+job store, session housekeeping) run on asyncio.to_thread() so they never queue
+behind a full-night analysis. Upload sessions are kept in this
+process's own upload_sessions, as app.py does, so a session must be opened and
+finished against the same server process.
+"""
+import os
+import io
+import uuid
+import time
+import json
+import base64
+import asyncio
+import hashlib
+import tempfile
+import contextvars
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import aiofiles
+import asyncpg
+from quart import Quart, Response, g, request, jsonify, send_from_directory
+from quart_cors import cors
+
+import app as wsgi
+from app import (
+    PREPARED_STATEMENTS, RECORDING_FIELDS, RECORDINGS_PAGE_SIZE, RECORDINGS_MAX_PAGE_SIZE,
+    RECORDINGS_STREAM_ITERSIZE, INFERENCE_BACKENDS, UPLOAD_FOLDER, JOBS_FOLDER, DB_CONFIG, IDEMPOTENCY_KEY_HEADER,
+    TRACE_REQUEST_HEADER, UPLOAD_SESSION_IDLE_SECONDS, UploadSession,
+    DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS, DB_POOL_WAIT_SECONDS,
+    model_registry, inference_batcher, profile_cache, user_status_cache, recording_stats_cache,
+    http_requests, http_request_seconds, request_payload_bytes, audio_duration_seconds, db_query_seconds,
+)
+
+ANALYSIS_THREADS = 4
+UPLOAD_WRITE_BLOCK_BYTES = 1024 * 1024
+# Full-night uploads are far above Quart's 16 MB / 60 s defaults.
+MAX_UPLOAD_BYTES = 1024 * 1024 * 1024
+UPLOAD_BODY_TIMEOUT_SECONDS = 600
+
+app = Quart(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+app.config["BODY_TIMEOUT"] = UPLOAD_BODY_TIMEOUT_SECONDS
+app = cors(app)
+
+analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_THREADS, thread_name_prefix="analysis")
+db_pool = None
+db_pool_lock = asyncio.Lock()
+
+
+async def get_db_pool():
+    global db_pool
+    async with db_pool_lock:
+        if db_pool is None:
+            # The schema is applied by "python app.py migrate-schema", not at startup.
+            db_pool = await asyncpg.create_pool(
+                host=DB_CONFIG["host"], user=DB_CONFIG["user"], password=DB_CONFIG["password"],
+                database=DB_CONFIG["dbname"], min_size=DB_POOL_MIN_CONNECTIONS, max_size=DB_POOL_MAX_CONNECTIONS
+            )
+        return db_pool
+
+@asynccontextmanager
+async def pooled_connection():
+    """Yields a pooled asyncpg connection, or None when the database is unreachable."""
+    pool = conn = None
+    try:
+        pool = await get_db_pool()
+        conn = await pool.acquire(timeout=DB_POOL_WAIT_SECONDS)
+    except Exception as e:
+        print(f"❌ Database connection failed: {e}")
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            await pool.release(conn)
+
+async def run_query(conn, method, statement, *args, sql=None):
+    """Runs PREPARED_STATEMENTS[statement] (asyncpg prepares and caches it) and times it."""
+    started = time.perf_counter()
+    try:
+        return await getattr(conn, method)(sql or PREPARED_STATEMENTS[statement], *args)
+    finally:
+        elapsed = time.perf_counter() - started
+        db_query_seconds.observe(elapsed, query=statement)
+        wsgi.add_to_trace(f"db.{statement}", elapsed)
+
+def asyncpg_placeholders(sql):
+    """Rewrites psycopg2 %s placeholders as asyncpg $1, $2, ..."""
+    parts = sql.split("%s")
+    return parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+
+async def in_executor(fn, *args):
+    # Only for per-upload work (decode, hash, inference, encode); cheap calls use asyncio.to_thread().
+    # Runs in a copy of the request's context, so stage timers still reach its trace.
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(analysis_executor, context.run, fn, *args)
+
+
+@app.before_serving
+async def start_up():
+    os.makedirs(JOBS_FOLDER, exist_ok=True)
+    await in_executor(model_registry.current)
+    model_registry.start_watching()
+    await asyncio.to_thread(wsgi.resume_jobs)
+    try:
+        await get_db_pool()
+    except Exception as e:
+        print(f"❌ Database connection failed: {e}")
+
+@app.after_serving
+async def shut_down():
+    if db_pool is not None:
+        await db_pool.close()
+    analysis_executor.shutdown(wait=False)
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+    wsgi.request_trace.set(OrderedDict() if request.headers.get(TRACE_REQUEST_HEADER) else None)
+
+@app.after_request
+async def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    elapsed = time.perf_counter() - g.get("request_started", time.perf_counter())
+    http_requests.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+    http_request_seconds.observe(elapsed, method=request.method, endpoint=endpoint)
+    if request.content_length:
+        request_payload_bytes.observe(request.content_length, endpoint=endpoint)
+    timings = wsgi.request_trace.get()
+    if timings is not None:
+        response.headers["Server-Timing"] = wsgi.server_timing_header(timings, elapsed)
+    return response
+
+
+def analyze_audio_bytes(audio_bytes):
+    """Executor side of an in-memory upload: (result, encoded storage copy or None)."""
+    audio_segment = wsgi.decode_audio(audio_bytes)
+    y = wsgi.load_signal(audio_segment)
+    analysis = wsgi.IncrementalAnalysis()
+    block = int(wsgi.ANALYSIS_BLOCK_SECONDS * analysis.sr)
+    for start in range(0, len(y), block):
+        analysis.feed(y[start:start + block])
+    result = analysis.finish()
+    if result["chunks_analyzed"] == 0:
+        return result, None
+    encoded = io.BytesIO()
+    with wsgi.stage_timer("storage_write"):
+        wsgi.export_recording(audio_segment, encoded)
+    return result, encoded.getvalue()
+
+def analyze_audio_file(audio_path, file_path):
+    """Executor side of a spooled upload: streams the analysis, then transcodes it to file_path."""
+    analysis = wsgi.IncrementalAnalysis()
+    for y in wsgi.stream_signal(audio_path, analysis.sr):
+        analysis.feed(y)
+    result = analysis.finish()
+    if result["chunks_analyzed"]:
+        with wsgi.stage_timer("storage_write"):
+            wsgi.transcode_recording(audio_path, file_path)
+    return result
+
+class DuplicateUpload(Exception):
+    """Raised inside store_recording()'s transaction when another request stored the same upload first."""
+
+
+async def store_recording(conn, user_uid, name, duration_millis, result, file_name, upload_key=None):
+    """
+    Inserts the recordings row and its daily rollup in one transaction; returns the app's
+    JSON body. When upload_key (content_hash, idempotency_key) was stored first by another
+    request, the insert is rolled back, file_name removed and the earlier result returned.
+    """
+    current_time = datetime.now()
+    # เวลากรน = เวลาเริ่มต้น + เวลาชดเชย
+    snoring_absolute_timestamps = [current_time + timedelta(seconds=relative_sec) for relative_sec in result["snoring_times_seconds"]]
+    file_url = f"/uploads/{file_name}"
+    duration_millis = int(duration_millis) if duration_millis is not None else None
+
+    try:
+        async with conn.transaction():
+            new_id = await run_query(
+                conn, "fetchval", "insert_recording",
+                user_uid, name, current_time, result["snoring_count"], result["loudest_snore_db"], file_url,
+                duration_millis, result["apnea_events_count"], snoring_absolute_timestamps, result["model_version"]
+            )
+            await run_query(
+                conn, "execute", "upsert_envelope",
+                new_id, wsgi.CHUNK_SECONDS, result["loudness_envelope"], result["probability_envelope"]
+            )
+            if upload_key and user_uid is not None:
+                if await run_query(conn, "fetchval", "insert_upload", new_id, user_uid, *upload_key) is None:
+                    raise DuplicateUpload()
+            if user_uid is not None:
+                await run_query(
+                    conn, "execute", "upsert_daily_stats",
+                    user_uid, current_time, result["apnea_events_count"], duration_millis, result["loudest_snore_db"]
+                )
+    except DuplicateUpload:
+        os.remove(os.path.join(UPLOAD_FOLDER, file_name))
+        return await find_upload(conn, user_uid, *upload_key)
+    recording_stats_cache.invalidate(user_uid)
+    audio_duration_seconds.observe(result["seconds_analyzed"])
+    return wsgi.recording_response(new_id, result, file_url, snoring_absolute_timestamps)
+
+async def find_upload(conn, user_uid, content_hash, idempotency_key):
+    row = await run_query(conn, "fetchrow", "find_upload", user_uid, content_hash, idempotency_key)
+    return wsgi.duplicate_upload_response(tuple(row)) if row else None
+
+async def find_stored_upload(user_uid, content_hash, idempotency_key):
+    if user_uid is None:
+        return None
+    async with pooled_connection() as conn:
+        return await find_upload(conn, user_uid, content_hash, idempotency_key) if conn else None
+
+uploads_in_flight = {}
+
+async def deduplicated_upload(user_uid, content_hash, idempotency_key, analyse):
+    """app.deduplicated_upload() for a coroutine function analyse(upload_key)."""
+    if user_uid is None or content_hash is None:
+        return await analyse(None)
+
+    keys = [(user_uid, "content", content_hash)] + ([(user_uid, "key", idempotency_key)] if idempotency_key else [])
+    while True:
+        existing = await find_stored_upload(user_uid, content_hash, idempotency_key)
+        if existing is not None:
+            return existing, 200
+        # No await between the check and the insert, so no lock is needed on the event loop.
+        running = next((uploads_in_flight[k] for k in keys if k in uploads_in_flight), None)
+        if running is None:
+            done = asyncio.Event()
+            for k in keys:
+                uploads_in_flight[k] = done
+            break
+        try:
+            await asyncio.wait_for(running.wait(), wsgi.DUPLICATE_UPLOAD_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+    try:
+        return await analyse((content_hash, idempotency_key))
+    finally:
+        for k in keys:
+            if uploads_in_flight.get(k) is done:
+                del uploads_in_flight[k]
+        done.set()
+
+def sha256_hex(audio_bytes):
+    return hashlib.sha256(audio_bytes).hexdigest()
+
+async def store_written_recording(result, user_uid, name, duration_millis, file_name, upload_key=None):
+    """app.store_analysis() for a file already written: removes file_name unless a recording was stored."""
+    file_path = os.path.join(UPLOAD_FOLDER, file_name)
+    response = None
+    try:
+        async with pooled_connection() as conn:
+            if not conn:
+                return {"error": "Database error", "message": "Failed to connect to the database."}, 500
+            response = await store_recording(conn, user_uid, name, duration_millis, result, file_name, upload_key)
+    finally:
+        if response is None and os.path.exists(file_path):
+            os.remove(file_path)
+    return response, 200
+
+async def analyze_and_store(audio_bytes, user_uid, name, duration_millis, upload_key=None):
+    result, encoded = await in_executor(analyze_audio_bytes, audio_bytes)
+    if encoded is None:
+        return {"error": "Analysis failed", "message": "Audio is too short for analysis."}, 400
+
+    file_name = wsgi.recording_file_name(user_uid, name)
+    file_path = os.path.join(UPLOAD_FOLDER, file_name)
+    try:
+        async with aiofiles.open(file_path, "wb") as f:
+            await f.write(encoded)
+    except BaseException:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    return await store_written_recording(result, user_uid, name, duration_millis, file_name, upload_key)
+
+async def analyze_file_and_store(audio_path, user_uid, name, duration_millis, upload_key=None):
+    file_name = wsgi.recording_file_name(user_uid, name)
+    file_path = os.path.join(UPLOAD_FOLDER, file_name)
+    try:
+        result = await in_executor(analyze_audio_file, audio_path, file_path)
+    except BaseException:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    if result["chunks_analyzed"] == 0:
+        return {"error": "Analysis failed", "message": "Audio is too short for analysis."}, 400
+    return await store_written_recording(result, user_uid, name, duration_millis, file_name, upload_key)
+
+def parse_upload_json(body):
+    """Executor side of a base64 JSON upload: (audio_bytes, user_uid, name, duration_millis)."""
+    data = json.loads(body) if body else {}
+    audio_base64 = data.get("audio_data")
+    audio_bytes = base64.b64decode(audio_base64) if audio_base64 else b""
+    return audio_bytes, data.get("user_uid"), data.get("name", "Unnamed Recording"), data.get("duration_millis")
+
+async def read_upload_request():
+    """Async read_upload_request(): base64 JSON, multipart "audio" file or raw body with query metadata."""
+    if request.is_json:
+        return await in_executor(parse_upload_json, await request.get_data(cache=False))
+
+    if request.mimetype == "multipart/form-data":
+        files = await request.files
+        upload = files.get("audio")
+        audio_bytes = await in_executor(upload.read) if upload else b""
+        fields = await request.form
+    else:
+        audio_bytes = await request.get_data(cache=False)
+        fields = request.args
+    return audio_bytes, fields.get("user_uid"), fields.get("name", "Unnamed Recording"), fields.get("duration_millis", type=int)
+
+async def spool_upload_request(audio_path):
+    """read_upload_request() that writes the audio to audio_path; returns (size, user_uid, name, duration_millis)."""
+    if request.is_json:
+        audio_bytes, user_uid, name, duration_millis = await read_upload_request()
+        async with aiofiles.open(audio_path, "wb") as f:
+            await f.write(audio_bytes)
+        return len(audio_bytes), user_uid, name, duration_millis
+
+    if request.mimetype == "multipart/form-data":
+        files = await request.files
+        upload = files.get("audio")
+        if upload:
+            await upload.save(audio_path)
+        else:
+            async with aiofiles.open(audio_path, "wb"):
+                pass
+        fields = await request.form
+    else:
+        async with aiofiles.open(audio_path, "wb") as f:
+            async for block in request.body:
+                await f.write(block)
+        fields = request.args
+    return os.path.getsize(audio_path), fields.get("user_uid"), fields.get("name", "Unnamed Recording"), fields.get("duration_millis", type=int)
+
+
+def model_loaded():
+    # Read directly: the model is loaded in start_up() and swapped by the watcher or /admin/reload-model.
+    return model_registry.serving is not None
+
+def model_not_loaded():
+    return jsonify({"error": "Model not loaded", "message": "The AI model failed to load on the server."}), 500
+
+@app.route("/analyze-audio", methods=["POST"])
+async def analyze_audio():
+    """Receives base64 audio data, analyzes it for snoring, and saves results."""
+    if not model_loaded():
+        return model_not_loaded()
+
+    try:
+        audio_bytes, user_uid, name, duration_millis = await in_executor(parse_upload_json, await request.get_data(cache=False))
+        if not audio_bytes:
+            return jsonify({"error": "Invalid input", "message": "Missing audio_data"}), 400
+
+        body, status = await deduplicated_upload(
+            user_uid, await in_executor(sha256_hex, audio_bytes), request.headers.get(IDEMPOTENCY_KEY_HEADER),
+            lambda upload_key: analyze_and_store(audio_bytes, user_uid, name, duration_millis, upload_key)
+        )
+        return jsonify(body), status
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Error during audio analysis: {e}")
+        return jsonify({"error": "Internal server error during analysis", "message": str(e)}), 500
+
+@app.route("/analyze-audio/binary", methods=["POST"])
+async def analyze_audio_binary():
+    """Same as /analyze-audio without the base64 JSON wrapper (multipart or raw octet-stream body)."""
+    if not model_loaded():
+        return model_not_loaded()
+
+    try:
+        if wsgi.use_streaming_analysis(request.content_length):
+            fd, audio_path = tempfile.mkstemp(dir=UPLOAD_FOLDER, suffix=".upload")
+            os.close(fd)
+            try:
+                size, user_uid, name, duration_millis = await spool_upload_request(audio_path)
+                if not size:
+                    return jsonify({"error": "Invalid input", "message": "Missing audio data"}), 400
+                body, status = await deduplicated_upload(
+                    user_uid, await in_executor(wsgi.file_sha256, audio_path), request.headers.get(IDEMPOTENCY_KEY_HEADER),
+                    lambda upload_key: analyze_file_and_store(audio_path, user_uid, name, duration_millis, upload_key)
+                )
+            finally:
+                os.remove(audio_path)
+            return jsonify(body), status
+
+        audio_bytes, user_uid, name, duration_millis = await read_upload_request()
+        if not audio_bytes:
+            return jsonify({"error": "Invalid input", "message": "Missing audio data"}), 400
+
+        body, status = await deduplicated_upload(
+            user_uid, await in_executor(sha256_hex, audio_bytes), request.headers.get(IDEMPOTENCY_KEY_HEADER),
+            lambda upload_key: analyze_and_store(audio_bytes, user_uid, name, duration_millis, upload_key)
+        )
+        return jsonify(body), status
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Error during audio analysis: {e}")
+        return jsonify({"error": "Internal server error during analysis", "message": str(e)}), 500
+
+@app.route("/analyze-audio/jobs", methods=["POST"])
+async def create_analysis_job():
+    """Queues an upload on app.py's job worker processes and returns its job id immediately."""
+    if not model_loaded():
+        return model_not_loaded()
+
+    try:
+        await asyncio.to_thread(wsgi.get_job_executor)
+        job_id = uuid.uuid4().hex
+        audio_path = os.path.join(JOBS_FOLDER, f"{job_id}.upload")
+        size, user_uid, name, duration_millis = await spool_upload_request(audio_path)
+        if not size:
+            os.remove(audio_path)
+            return jsonify({"error": "Invalid input", "message": "Missing audio data"}), 400
+
+        content_hash = await in_executor(wsgi.file_sha256, audio_path)
+        idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        existing = await find_stored_upload(user_uid, content_hash, idempotency_key)
+        if existing is not None:
+            os.remove(audio_path)
+            await asyncio.to_thread(wsgi.record_duplicate_job, job_id, audio_path, user_uid, name, duration_millis, existing)
+            return jsonify({"job_id": job_id, "status": "done", "status_url": f"/analyze-audio/jobs/{job_id}"}), 200
+
+        if not await asyncio.to_thread(
+            wsgi.enqueue_job, job_id, audio_path, user_uid, name, duration_millis, content_hash, idempotency_key
+        ):
+            os.remove(audio_path)
+            response = jsonify({"error": "Busy", "message": "Too many analysis jobs in progress, please retry later."})
+            response.headers["Retry-After"] = "30"
+            return response, 503
+        return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/analyze-audio/jobs/{job_id}"}), 202
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Error queueing analysis job: {e}")
+        return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+@app.route("/analyze-audio/jobs/<job_id>", methods=["GET"])
+async def get_analysis_job(job_id):
+    job = await asyncio.to_thread(wsgi.get_job, job_id)
+    if job is None:
+        return jsonify({"error": "Not Found", "message": "Job not found"}), 404
+    return jsonify(wsgi.job_status_body(job)), 200
+
+upload_sessions = {}
+
+def discard_sessions(sessions):
+    for session in sessions:
+        with session.lock:
+            session.discard()
+
+async def expire_upload_sessions():
+    now = time.monotonic()
+    expired = [sid for sid, s in upload_sessions.items() if now - s.last_activity > UPLOAD_SESSION_IDLE_SECONDS]
+    if expired:
+        await asyncio.to_thread(discard_sessions, [upload_sessions.pop(sid) for sid in expired])
+
+def finish_upload_session(session):
+    """Executor side of finalize: (result, stored file name or None when too short)."""
+    with session.lock:
+        result = session.analysis.finish()
+        session.close_audio()
+        if result["chunks_analyzed"] == 0:
+            return result, None
+        return result, wsgi.write_recording(
+            session.user_uid, session.name, lambda file_path: wsgi.transcode_recording(session.part_path, file_path)
+        )
+
+@app.route("/upload-sessions", methods=["POST"])
+async def open_upload_session():
+    if not model_loaded():
+        return model_not_loaded()
+
+    data = await request.get_json(silent=True) or {}
+    user_uid = data.get("user_uid")
+    if not user_uid:
+        return jsonify({"error": "Invalid input", "message": "Missing user_uid"}), 400
+
+    await expire_upload_sessions()
+    session = UploadSession(uuid.uuid4().hex, user_uid, data.get("name", "Unnamed Recording"))
+    upload_sessions[session.session_id] = session
+    return jsonify(session.status()), 201
+
+@app.route("/upload-sessions/<session_id>", methods=["GET"])
+async def get_upload_session_status(session_id):
+    session = upload_sessions.get(session_id)
+    if session is None:
+        return jsonify({"error": "Not Found", "message": "Upload session not found"}), 404
+    return jsonify(session.status()), 200
+
+@app.route("/upload-sessions/<session_id>/segments", methods=["POST"])
+async def append_upload_segment(session_id):
+    session = upload_sessions.get(session_id)
+    if session is None:
+        return jsonify({"error": "Not Found", "message": "Upload session not found"}), 404
+
+    try:
+        data = await request.get_json(silent=True) or {}
+        seq = data.get("seq")
+        audio_base64 = data.get("audio_data")
+        if seq is None or not audio_base64:
+            return jsonify({"error": "Invalid input", "message": "Missing seq or audio_data"}), 400
+
+        body, status = await in_executor(wsgi.append_session_segment, session, seq, audio_base64)
+        return jsonify(body), status
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Error appending upload segment: {e}")
+        return jsonify({"error": "Internal server error during analysis", "message": str(e)}), 500
+
+@app.route("/upload-sessions/<session_id>/finalize", methods=["POST"])
+async def finalize_upload_session(session_id):
+    # Taken out of upload_sessions while it is stored, so a concurrent finalize gets 404
+    # rather than a second recording; it is put back if storing fails.
+    session = upload_sessions.pop(session_id, None)
+    if session is None:
+        return jsonify({"error": "Not Found", "message": "Upload session not found"}), 404
+
+    stored = False
+    file_name = None
+    try:
+        data = await request.get_json(silent=True) or {}
+        result, file_name = await in_executor(finish_upload_session, session)
+        if file_name is None:
+            return jsonify({"error": "Analysis failed", "message": "Audio is too short for analysis."}), 400
+
+        async with pooled_connection() as conn:
+            if not conn:
+                return jsonify({"error": "Database error", "message": "Failed to connect to the database."}), 500
+            body = await store_recording(conn, session.user_uid, session.name, data.get("duration_millis"), result, file_name)
+        stored = True
+        os.remove(session.part_path)
+        return jsonify(body), 200
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Error finalizing upload session: {e}")
+        return jsonify({"error": "Internal server error during analysis", "message": str(e)}), 500
+    finally:
+        if not stored:
+            upload_sessions[session_id] = session
+            if file_name and os.path.exists(os.path.join(UPLOAD_FOLDER, file_name)):
+                os.remove(os.path.join(UPLOAD_FOLDER, file_name))
+
+@app.route("/admin/model", methods=["GET"])
+async def get_model_status():
+    return jsonify(model_registry.status()), 200
+
+@app.route("/admin/reload-model", methods=["POST"])
+async def reload_model():
+    data = await request.get_json(silent=True) or {}
+    backend_name = data.get("backend")
+    if backend_name is not None and backend_name not in INFERENCE_BACKENDS:
+        return jsonify({"error": "Invalid input", "message": f"Unknown backend: {backend_name}"}), 400
+    model_registry.reload_async(data.get("path"), backend_name)
+    return jsonify({"message": "Model reload started", **model_registry.status()}), 202
+
+@app.route("/inference-stats", methods=["GET"])
+async def get_inference_stats():
+    return jsonify(inference_batcher.stats()), 200
+
+@app.route("/cache-stats", methods=["GET"])
+async def get_cache_stats():
+    return jsonify({
+        "user_profile": profile_cache.stats(),
+        "user_status": user_status_cache.stats(),
+        "recording_stats": recording_stats_cache.stats(),
+    }), 200
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    return Response(wsgi.render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/save-user-profile", methods=["POST"])
+async def save_user_profiles():
+    """Receives user profiles data and saves it to the user_profile table."""
+    async with pooled_connection() as conn:
+        if not conn:
+            return jsonify({"error": "Database error", "message": "Failed to connect to the database."}), 500
+        try:
+            data = await request.get_json()
+            user_uid = data.get("uid")
+            first_name = data.get("firstName")
+            last_name = data.get("lastName")
+            sex = data.get("gender")
+
+            if not all([user_uid, first_name, last_name, sex]):
+                return jsonify({"error": "Invalid input", "message": "Missing required profile fields (uid, firstName, lastName, gender)."}), 400
+
+            await run_query(conn, "fetchval", "save_user_profile", user_uid, first_name, last_name, sex, datetime.now())
+            profile_cache.invalidate(user_uid)
+            user_status_cache.invalidate(user_uid)
+            return jsonify({'message': 'User profile saved successfully', 'user_uid': user_uid}), 201
+
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error saving user profile: {e}")
+            return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+@app.route('/uploads/<filename>')
+async def uploaded_file(filename):
+    """Serves stored recordings; Range requests get 206 partial content."""
+    return await send_from_directory(UPLOAD_FOLDER, filename, conditional=True)
+
+@app.route("/get-user-profile/<user_uid>", methods=["GET"])
+async def get_user_profile(user_uid):
+    async def load_profile():
+        async with pooled_connection() as conn:
+            if not conn:
+                return ({"error": "Database error", "message": "Failed to connect to the database."}, 500), False
+            try:
+                row = await run_query(conn, "fetchrow", "get_user_profile", user_uid)
+                if not row:
+                    return ({"error": "Not Found", "message": "User profile not found"}, 404), False
+                return ({
+                    "user_uid": row[0],
+                    "first_name": row[1],
+                    "last_name": row[2],
+                    "sex": row[3],
+                    "created_at": row[4].isoformat() if row[4] else None
+                }, 200), True
+            except Exception as e:
+                print(f"Error fetching user profile: {e}")
+                return ({"error": "Internal server error", "message": str(e)}, 500), False
+
+    body, status = await profile_cache.get_or_load_async(user_uid, load_profile)
+    return jsonify(body), status
+
+@app.route('/get-recording-stats/<uid>', methods=['GET'])
+async def get_recording_stats(uid):
+    async def load_stats():
+        async with pooled_connection() as conn:
+            if not conn:
+                return ({"error": "Database error", "message": "Failed to connect to the database."}, 500), False
+            try:
+                row = await run_query(conn, "fetchrow", "get_recording_stats", uid)
+                return ({
+                    'total_days': row[0] or 0,
+                    'avg_duration': round(row[1] or 0, 2),
+                    'avg_apnea_count': round(row[2] or 0, 2),
+                    'max_snore_db': round(row[3] or 0, 2)
+                }, 200), True
+            except Exception as e:
+                print(f" Error in /get-recording-stats: {e}")
+                return ({"error": "Internal server error", "message": str(e)}, 500), False
+
+    body, status = await recording_stats_cache.get_or_load_async(uid, load_stats)
+    return jsonify(body), status
+
+@app.route("/get-recordings/<user_uid>", methods=["GET"])
+async def get_recordings(user_uid):
+    """Same query parameters and replies as app.py's /get-recordings."""
+    fields = request.args.get("fields")
+    fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(RECORDING_FIELDS)
+    unknown = [f for f in fields if f not in RECORDING_FIELDS]
+    if unknown:
+        return jsonify({"error": "Invalid input", "message": f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    paginated = "limit" in request.args or "cursor" in request.args
+    try:
+        limit = min(max(request.args.get("limit", RECORDINGS_PAGE_SIZE, type=int), 1), RECORDINGS_MAX_PAGE_SIZE)
+        keyset = wsgi.decode_recordings_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid input", "message": "Invalid limit or cursor"}), 400
+
+    params = (user_uid,) + (keyset or ())
+    if paginated:
+        async with pooled_connection() as conn:
+            if not conn:
+                return jsonify({"error": "Database error", "message": "Failed to connect to the database."}), 500
+            try:
+                sql = asyncpg_placeholders(wsgi.recording_rows_query(fields, keyset) + " LIMIT %s")
+                rows = [tuple(r) for r in await run_query(conn, "fetch", "get_recordings_page", *params, limit + 1, sql=sql)]
+                next_cursor = wsgi.encode_recordings_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+                return jsonify({
+                    "recordings": [wsgi.recording_row_to_json(fields, r) for r in rows[:limit]],
+                    "next_cursor": next_cursor
+                })
+            except Exception as e:
+                print(f"Error fetching recordings: {e}")
+                return jsonify({"error": "Internal server error", "message": "Failed to fetch recordings."}), 500
+
+    try:
+        await get_db_pool()
+    except Exception as e:
+        print(f"❌ Database connection failed: {e}")
+        return jsonify({"error": "Database error", "message": "Failed to connect to the database."}), 500
+
+    async def generate():
+        # The connection is taken inside the generator, so a client that never reads
+        # the body cannot hold one.
+        async with pooled_connection() as conn:
+            if not conn:
+                raise RuntimeError("Failed to connect to the database.")
+            async with conn.transaction():
+                yield "["
+                sql = asyncpg_placeholders(wsgi.recording_rows_query(fields, None))
+                i = 0
+                async for r in conn.cursor(sql, *params, prefetch=RECORDINGS_STREAM_ITERSIZE):
+                    yield ("," if i else "") + app.json.dumps(wsgi.recording_row_to_json(fields, tuple(r)))
+                    i += 1
+                yield "]"
+
+    return Response(generate(), mimetype="application/json")
+
+@app.route("/recording-envelope/<int:recording_id>", methods=["GET"])
+async def get_recording_envelope(recording_id):
+    try:
+        points, binary = wsgi.envelope_request_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": "Invalid input", "message": str(e)}), 400
+
+    async with pooled_connection() as conn:
+        if not conn:
+            return jsonify({"error": "Database error", "message": "Failed to connect to the database."}), 500
+        try:
+            row = await run_query(conn, "fetchrow", "get_envelope", recording_id)
+        except Exception as e:
+            print(f"Error fetching recording envelope: {e}")
+            return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+    if not row:
+        return jsonify({"error": "Not Found", "message": "No envelope stored for this recording"}), 404
+    body, mimetype, headers = wsgi.envelope_response(recording_id, tuple(row), points, binary)
+    return Response(body, mimetype=mimetype, headers=headers)
+
+@app.route("/admin/get-all-user-stats", methods=["GET"])
+async def get_all_user_stats():
+    async with pooled_connection() as conn:
+        if not conn:
+            return jsonify({"error": "Database error", "message": "Failed to connect to the database."}), 500
+        try:
+            rows = await run_query(conn, "fetch", "get_all_user_stats")
+            results = [
+                {
+                    "id": r[0],
+                    "user_uid": r[0],
+                    "firstName": r[1],
+                    "lastName": r[2],
+                    "fullName": f"{r[1]} {r[2]}",
+                    "isDeleted": r[3],
+                    "createdAt": r[4].isoformat() if r[4] else 'N/A',
+                    "lastUsed": r[5].isoformat() if r[5] else 'N/A',
+                    "daysUsed": int(r[6] or 0),
+                    "totalDurationMillis": int(r[7] or 0)
+                }
+                for r in rows
+            ]
+            return jsonify(results), 200
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Error fetching admin user stats: {e}")
+            return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+@app.route('/admin/user-profile/<uid>', methods=['PUT'])
+async def update_user_profile(uid):
+    async with pooled_connection() as conn:
+        if not conn:
+            return jsonify({"message": "Database connection failed"}), 500
+        try:
+            data = await request.get_json()
+            if not data or 'is_deleted' not in data:
+                return jsonify({"message": "Missing required field: is_deleted"}), 400
+
+            is_deleted = data['is_deleted']
+            updated = await run_query(conn, "fetchval", "update_user_status", is_deleted, uid)
+            user_status_cache.invalidate(uid)
+            profile_cache.invalidate(uid)
+
+            if not updated:
+                return jsonify({"message": f"User {uid} not found"}), 404
+
+            action = "ระงับ" if is_deleted else "กู้คืน"
+            return jsonify({
+                "message": f"บัญชี {uid} ถูก{action}เรียบร้อยแล้ว",
+                "is_deleted": is_deleted
+            }), 200
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return jsonify({"message": f"Error updating user status: {str(e)}"}), 500
+
+@app.route("/user-status/<uid>", methods=["GET"])
+async def get_user_status(uid):
+    async def load_status():
+        async with pooled_connection() as conn:
+            if not conn:
+                return ({"message": "Database connection failed"}, 500), False
+            try:
+                row = await run_query(conn, "fetchrow", "get_user_status", uid)
+                if not row:
+                    return ({"message": "User not found", "isDeleted": False}, 404), False
+                return ({"isDeleted": row[0]}, 200), True
+            except Exception as e:
+                print("Error fetching user status:", e)
+                return ({"message": str(e)}, 500), False
+
+    body, status = await user_status_cache.get_or_load_async(uid, load_status)
+    return jsonify(body), status
@@ -0,0 +1,314 @@
+"""
+Benchmarks for the /analyze-audio pipeline and Train.extract_features().
+
+    python benchmark.py --durations 1,60,480 --formats wav,mp3 --output bench.json
+    python benchmark.py --output new.json --compare bench.json --tolerance 0.15
+    python benchmark.py --durations "" --train-clips 0 --gate-report C:/path/to/Sound
+
+Synthetic nights are generated block by block into a temporary WAV and encoded with
+ffmpeg, so no recordings or database are needed and a full night fits in memory.
+Uploads at or above STREAMING_ANALYSIS_MIN_BYTES are timed through the streaming path
+the server uses for them. Results are written as JSON; --compare exits with status 1 when a stage's median
+time grew by more than --tolerance relative to the baseline file.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import wave
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+
+import librosa
+import numpy as np
+from pydub import AudioSegment
+
+import app
+
+SOURCE_SR = 44100
+SYNTH_BLOCK_SECONDS = 60
+
+
+def synthesize_blocks(minutes, sr=SOURCE_SR, seed=0, block_seconds=SYNTH_BLOCK_SECONDS):
+    """Background noise with periodic snore-like bursts and occasional silent gaps, block_seconds at a time."""
+    rng = np.random.default_rng(seed)
+    seconds = int(minutes * 60)
+    t = np.arange(sr, dtype=np.float32) / sr
+    snore = (np.sin(2 * np.pi * 90 * t) * np.hanning(sr) * 0.3).astype(np.float32)
+    for block_start in range(0, seconds, block_seconds):
+        block_end = min(block_start + block_seconds, seconds)
+        y = (rng.standard_normal((block_end - block_start) * sr) * 0.005).astype(np.float32)
+        for second in range(block_start, block_end):
+            offset = (second - block_start) * sr
+            if second % 5 == 0 and second < seconds - 1 and rng.random() < 0.4:
+                y[offset:offset + sr] += snore
+            if second % 120 < 10 and second - second % 120 < seconds - 12:
+                y[offset:offset + sr] = 0
+        yield y
+
+
+def synthesize_night(minutes, sr=SOURCE_SR, seed=0):
+    return np.concatenate(list(synthesize_blocks(minutes, sr, seed)))
+
+
+def encode(y, fmt, sr=SOURCE_SR):
+    pcm = (np.clip(y, -1, 1) * 32767).astype(np.int16)
+    segment = AudioSegment(pcm.tobytes(), frame_rate=sr, sample_width=2, channels=1)
+    out = io.BytesIO()
+    segment.export(out, format=fmt)
+    return out.getvalue()
+
+
+def write_night(path, minutes, fmt, sr=SOURCE_SR):
+    """Writes a synthetic night to path in fmt without holding more than one block in memory."""
+    wav_path = path if fmt == "wav" else path + ".wav"
+    with wave.open(wav_path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        for y in synthesize_blocks(minutes, sr):
+            f.writeframes((np.clip(y, -1, 1) * 32767).astype(np.int16).tobytes())
+    if fmt != "wav":
+        subprocess.run(
+            [AudioSegment.converter, "-nostdin", "-y", "-loglevel", "error", "-i", wav_path, "-f", fmt, path],
+            check=True, capture_output=True
+        )
+        os.remove(wav_path)
+    return path
+
+
+def time_call(fn, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return result, {
+        "median_s": statistics.median(timings),
+        "min_s": min(timings),
+        "max_s": max(timings),
+        "runs": repeat,
+    }
+
+
+def bench_analysis(minutes, fmt, repeat, backend):
+    """Times each stage of analyze_and_store() (or of analyze_file_and_store() for large uploads) apart from the database insert."""
+    prefix = f"analysis/{fmt}/{minutes}min"
+    with tempfile.TemporaryDirectory() as tmp:
+        audio_path = write_night(os.path.join(tmp, f"night.{fmt}"), minutes, fmt)
+        results = {f"{prefix}/payload_bytes": {"value": os.path.getsize(audio_path)}}
+        if app.use_streaming_analysis(os.path.getsize(audio_path)):
+            results.update(bench_streamed_analysis(audio_path, prefix, repeat, backend))
+            return results
+
+        with open(audio_path, "rb") as f:
+            audio_bytes = f.read()
+
+    audio_segment, results[f"{prefix}/decode"] = time_call(lambda: app.decode_audio(audio_bytes), repeat)
+    y, results[f"{prefix}/resample"] = time_call(lambda: app.load_signal(audio_segment), repeat)
+
+    chunks = app.frame_chunks(y, int(app.CHUNK_SECONDS * app.TARGET_SR))
+    features, results[f"{prefix}/features"] = time_call(
+        lambda: app.extract_features_batch(chunks, app.TARGET_SR), repeat
+    )
+
+    if backend is not None:
+        X = np.expand_dims(features, axis=-1)
+        step = app.INFERENCE_MAX_BATCH_SIZE
+        _, results[f"{prefix}/predict"] = time_call(
+            lambda: [backend.predict(X[i:i + step]) for i in range(0, len(X), step)], repeat
+        )
+
+    def rms_scan():
+        rms = app.per_second_rms(y, app.TARGET_SR)
+        app.scan_silence_runs(rms)
+        return app.rms_to_snore_db(rms).max()
+    _, results[f"{prefix}/rms_apnea_scan"] = time_call(rms_scan, repeat)
+
+    _, results[f"{prefix}/storage_export"] = time_call(
+        lambda: app.export_recording(audio_segment, io.BytesIO()), repeat
+    )
+
+    results[f"{prefix}/chunks"] = {"value": int(len(chunks))}
+    return results
+
+
+def bench_streamed_analysis(audio_path, prefix, repeat, backend):
+    """The streaming path: stream_signal() decode and resample, IncrementalAnalysis and the ffmpeg transcode."""
+    chunk_samples = int(app.CHUNK_SECONDS * app.TARGET_SR)
+    samples, timing = time_call(lambda: sum(len(y) for y in app.stream_signal(audio_path)), repeat)
+    results = {f"{prefix}/stream_decode_resample": timing}
+
+    if backend is not None:
+        def analyse():
+            analysis = app.IncrementalAnalysis(model=(app.model_registry.status()["version"], backend))
+            for y in app.stream_signal(audio_path, analysis.sr):
+                analysis.feed(y)
+            return analysis.finish()
+        _, results[f"{prefix}/stream_analysis"] = time_call(analyse, repeat)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stored_path = os.path.join(tmp, "stored" + app.STORAGE_FORMATS[app.STORAGE_FORMAT][0])
+        _, results[f"{prefix}/storage_transcode"] = time_call(lambda: app.transcode_recording(audio_path, stored_path), repeat)
+
+    results[f"{prefix}/chunks"] = {"value": samples // chunk_samples}
+    return results
+
+
+def bench_training_extraction(clips, repeat, workers):
+    """Files/second of Train.extract_features() on 4-second WAV clips."""
+    import Train
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        y = synthesize_night(clips * 4 / 60, seed=1)
+        step = 4 * SOURCE_SR
+        paths = []
+        for i in range(clips):
+            path = os.path.join(tmp, f"clip_{i:05d}.wav")
+            with open(path, "wb") as f:
+                f.write(encode(y[i * step:(i + 1) * step], "wav"))
+            paths.append(path)
+
+        _, timing = time_call(lambda: [Train.extract_features(p) for p in paths], repeat)
+        timing["files_per_s"] = clips / timing["median_s"]
+        results["train/extract_features/serial"] = timing
+
+        if workers > 1:
+            _, timing = time_call(lambda: list(Train.iter_extract_features(paths, workers=workers)), repeat)
+            timing["files_per_s"] = clips / timing["median_s"]
+            results[f"train/extract_features/{workers}_workers"] = timing
+    return results
+
+
+def gate_report(data_dir, thresholds, backend):
+    """
+    Runs the analysis over the labelled class1/class2 clips under data_dir with the
+    energy gate off and at each threshold, reporting chunks skipped, the change in
+    snoring_count and accuracy against the labels (class2 is the snoring class, as in
+    the LabelBinarizer used by Train.py).
+    """
+    import Train
+
+    model = (app.model_registry.status()["version"], backend)
+    clips = [(librosa.load(path, sr=app.TARGET_SR)[0], label) for path, label in Train.collect_audio_files(data_dir)]
+    results = {}
+    baseline = None
+    print(f"{'gate':>8} {'chunks':>8} {'skipped':>8} {'snoring':>8} {'changed':>8} {'accuracy':>9} {'seconds':>8}")
+    for threshold in [0.0] + thresholds:
+        counts, chunks, skipped, correct, scored_clips = [], 0, 0, 0, 0
+        started = time.perf_counter()
+        for y, label in clips:
+            analysis = app.IncrementalAnalysis(model=model, energy_gate=threshold)
+            analysis.feed(y)
+            result = analysis.finish()
+            counts.append(result["snoring_count"])
+            chunks += result["chunks_analyzed"]
+            skipped += result["chunks_skipped"]
+            if result["chunks_analyzed"]:
+                scored_clips += 1
+                correct += (result["snoring_count"] > 0) == (label == "class2")
+        elapsed = time.perf_counter() - started
+        baseline = baseline or counts
+        entry = {
+            "clips": scored_clips,
+            "chunks": chunks,
+            "chunks_skipped": skipped,
+            "skipped_ratio": skipped / chunks if chunks else 0,
+            "snoring_count": sum(counts),
+            "snoring_count_change": sum(counts) - sum(baseline),
+            "clips_changed": sum(a != b for a, b in zip(counts, baseline)),
+            "accuracy": correct / scored_clips if scored_clips else 0,
+            # A single run, so not "median_s": compare() only flags repeated timings.
+            "seconds": elapsed,
+        }
+        results[f"energy_gate/{threshold:g}"] = entry
+        print(f"{threshold:8g} {chunks:8d} {skipped:8d} {entry['snoring_count']:8d} {entry['clips_changed']:8d} "
+              f"{entry['accuracy']:9.4f} {elapsed:8.2f}")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns [(key, baseline_s, current_s, ratio)] for stages slower than tolerance allows."""
+    regressions = []
+    for key, current in sorted(results.items()):
+        previous = baseline.get(key)
+        if not previous or "median_s" not in current or "median_s" not in previous:
+            continue
+        ratio = current["median_s"] / previous["median_s"] if previous["median_s"] else float("inf")
+        flag = "REGRESSION" if ratio > 1 + tolerance else ""
+        print(f"{key:55s} {previous['median_s']:10.4f}s -> {current['median_s']:10.4f}s  x{ratio:5.2f} {flag}")
+        if flag:
+            regressions.append((key, previous["median_s"], current["median_s"], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the snoring analysis and training pipelines")
+    parser.add_argument("--durations", default="1,60", help="comma-separated recording lengths in minutes (480 = full night)")
+    parser.add_argument("--formats", default="wav,mp3", help="comma-separated input formats")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--train-clips", type=int, default=200, help="clips for the Train.extract_features benchmark (0 = skip)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--no-model", action="store_true", help="skip the predict stage")
+    parser.add_argument("--gate-report", metavar="DATA_DIR", help="labelled class1/class2 clips for the energy gate report")
+    parser.add_argument("--gate-thresholds", default=f"0.005,{app.ENERGY_GATE_RMS:g},0.02", help="comma-separated gate RMS values to report")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="baseline JSON written by an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown before a stage is flagged")
+    args = parser.parse_args()
+
+    backend = None
+    if not args.no_model:
+        current = app.model_registry.current()
+        backend = current[1] if current else None
+        if backend is None:
+            print("Model not available; the predict stage is skipped.")
+
+    results = {}
+    for minutes in [float(m) if "." in m else int(m) for m in args.durations.split(",") if m]:
+        for fmt in args.formats.split(","):
+            print(f"Benchmarking {fmt} / {minutes} min ...")
+            results.update(bench_analysis(minutes, fmt, args.repeat, backend))
+    if args.train_clips:
+        print("Benchmarking Train.extract_features ...")
+        results.update(bench_training_extraction(args.train_clips, args.repeat, args.workers))
+    if args.gate_report:
+        if backend is None:
+            raise SystemExit("The energy gate report needs the model.")
+        print("Energy gate report ...")
+        results.update(gate_report(args.gate_report, [float(t) for t in args.gate_thresholds.split(",")], backend))
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "model_version": app.model_registry.status()["version"] if backend is not None else None,
+            "inference_backend": app.model_registry.backend_name,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage(s) regressed by more than {args.tolerance:.0%}.")
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Re-scores stored recordings with the current model and writes the results back.
+
+    python reanalyze.py                              # every recording
+    python reanalyze.py --user UID --since 2024-01-01 --until 2024-02-01
+    python reanalyze.py --workers 4 --write-batch 200
+
+Each worker process loads its own copy of the configured model and analyses one
+recording at a time with the streaming decoder, scoring ANALYSIS_BLOCK_SECONDS of
+chunks per forward pass. Results and their envelopes are written once per batch and the
+last written id is checkpointed, so an interrupted run picks up where it stopped
+as long as the filters and the model file are unchanged. Recordings that failed
+are retried when the run is resumed.
+"""
+import os
+import json
+import argparse
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+from psycopg2.extras import execute_values
+
+import app
+
+CHECKPOINT_PATH = "reanalyze_checkpoint.json"
+WRITE_BATCH_SIZE = 100
+REANALYSIS_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+UPDATE_RECORDINGS_SQL = """
+    UPDATE recordings AS r SET
+        snoring_count = v.snoring_count,
+        loudest_snore_db = v.loudest_snore_db,
+        apnea_events_count = v.apnea_events_count,
+        snoring_absolute_timestamps = v.snoring_absolute_timestamps,
+        model_version = v.model_version
+    FROM (VALUES %s) AS v(id, snoring_count, loudest_snore_db, apnea_events_count, snoring_absolute_timestamps, model_version)
+    WHERE r.id = v.id
+"""
+UPDATE_RECORDINGS_TEMPLATE = "(%s, %s, %s::double precision, %s, %s::timestamp[], %s)"
+UPSERT_ENVELOPES_SQL = """
+    INSERT INTO recording_envelopes (recording_id, chunk_seconds, loudness_db, snore_probability)
+    VALUES %s
+    ON CONFLICT (recording_id) DO UPDATE SET
+        chunk_seconds = EXCLUDED.chunk_seconds,
+        loudness_db = EXCLUDED.loudness_db,
+        snore_probability = EXCLUDED.snore_probability
+"""
+
+
+def init_worker():
+    # Unlike job workers, the model is not watched: a run must use one model throughout.
+    app.model_registry.current()
+
+def reanalyze_recording(task):
+    """Runs in a worker: returns (recording_id, result, error) for one stored file."""
+    recording_id, file_url = task
+    audio_path = os.path.join(app.UPLOAD_FOLDER, os.path.basename(file_url or ""))
+    if not file_url or not os.path.exists(audio_path):
+        return recording_id, None, f"file not found: {audio_path}"
+    try:
+        analysis = app.IncrementalAnalysis()
+        for y in app.stream_signal(audio_path, analysis.sr, block_seconds=app.ANALYSIS_BLOCK_SECONDS):
+            analysis.feed(y)
+        return recording_id, analysis.finish(), None
+    except Exception as e:
+        return recording_id, None, str(e)
+
+
+def load_checkpoint(path, run_key):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    return checkpoint if checkpoint.get("run") == run_key else None
+
+def save_checkpoint(path, checkpoint):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def select_recordings(cur, users, since, until, after_id, retry_ids=()):
+    conditions, params = ["(id > %s OR id = ANY(%s))"], [after_id, list(retry_ids)]
+    if users:
+        conditions.append("user_uid = ANY(%s)")
+        params.append(list(users))
+    if since:
+        conditions.append("created_at >= %s")
+        params.append(since)
+    if until:
+        conditions.append("created_at < %s")
+        params.append(until)
+    cur.execute(
+        f"SELECT id, created_at, file_url FROM recordings WHERE {' AND '.join(conditions)} ORDER BY id",
+        params
+    )
+    return cur.fetchall()
+
+def write_results(conn, rows, envelopes):
+    cur = conn.cursor()
+    execute_values(cur, UPDATE_RECORDINGS_SQL, rows, template=UPDATE_RECORDINGS_TEMPLATE, page_size=len(rows))
+    execute_values(cur, UPSERT_ENVELOPES_SQL, envelopes, page_size=len(envelopes))
+    conn.commit()
+    cur.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score stored recordings with the current model")
+    parser.add_argument("--user", action="append", default=[], help="only this user_uid (repeatable)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="only recordings created at or after this date")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="only recordings created before this date")
+    parser.add_argument("--workers", type=int, default=REANALYSIS_WORKERS)
+    parser.add_argument("--write-batch", type=int, default=WRITE_BATCH_SIZE, help="recordings per bulk UPDATE")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    args = parser.parse_args()
+
+    model_version = app.model_file_version(app.model_registry.path)
+    run_key = {
+        "users": sorted(args.user),
+        "since": args.since.isoformat() if args.since else None,
+        "until": args.until.isoformat() if args.until else None,
+        "model_version": model_version,
+    }
+    checkpoint = None if args.restart else load_checkpoint(args.checkpoint, run_key)
+    if checkpoint is None:
+        checkpoint = {"run": run_key, "last_id": 0, "updated": 0, "failed": {}}
+    else:
+        print(f"Resuming after recording {checkpoint['last_id']} ({checkpoint['updated']} already updated).")
+
+    with app.pooled_connection() as conn:
+        if not conn:
+            raise SystemExit("Failed to connect to the database.")
+        cur = conn.cursor()
+        retry_ids = [int(recording_id) for recording_id in checkpoint["failed"]]
+        recordings = select_recordings(cur, args.user, args.since, args.until, checkpoint["last_id"], retry_ids)
+        cur.close()
+        conn.commit()
+        print(f"Re-analysing {len(recordings)} recordings ({len(retry_ids)} failed earlier) with {model_version} on {args.workers} workers.")
+        created_at = {recording_id: created for recording_id, created, _ in recordings}
+
+        pending, envelopes = [], []
+        def flush():
+            if pending:
+                write_results(conn, pending, envelopes)
+                checkpoint["updated"] += len(pending)
+                pending.clear()
+                envelopes.clear()
+            save_checkpoint(args.checkpoint, checkpoint)
+
+        executor = ProcessPoolExecutor(
+            max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker
+        )
+        with executor:
+            tasks = [(recording_id, file_url) for recording_id, _, file_url in recordings]
+            # map() yields in id order, so every id up to last_id is written once its batch commits.
+            for done, (recording_id, result, error) in enumerate(executor.map(reanalyze_recording, tasks), 1):
+                if error is None and result["model_version"] != model_version:
+                    # Keep what was scored with the old model, and drop the queued recordings
+                    # instead of letting the executor's exit wait for all of them.
+                    flush()
+                    executor.shutdown(cancel_futures=True)
+                    raise SystemExit(f"The model file changed during the run ({result['model_version']}); rerun to continue.")
+                if error is not None:
+                    print(f"Recording {recording_id} failed: {error}")
+                    checkpoint["failed"][str(recording_id)] = error
+                else:
+                    checkpoint["failed"].pop(str(recording_id), None)
+                    timestamps = [created_at[recording_id] + timedelta(seconds=s) for s in result["snoring_times_seconds"]]
+                    pending.append((
+                        recording_id, result["snoring_count"], result["loudest_snore_db"],
+                        result["apnea_events_count"], timestamps, result["model_version"]
+                    ))
+                    envelopes.append((
+                        recording_id, app.CHUNK_SECONDS, result["loudness_envelope"], result["probability_envelope"]
+                    ))
+                # Retried ids lie below last_id and must not move it back.
+                checkpoint["last_id"] = max(checkpoint["last_id"], recording_id)
+                if len(pending) >= args.write_batch:
+                    flush()
+                    print(f"{done}/{len(recordings)} recordings processed")
+            flush()
+
+    print(f"Updated {checkpoint['updated']} recordings, {len(checkpoint['failed'])} failed.")
+    if checkpoint["updated"]:
+        # apnea_events_sum and max_snore_db in the daily rollup follow the rescored rows.
+        app.backfill_daily_stats()
+
+
+if __name__ == "__main__":
+    main()
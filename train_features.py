@@ -0,0 +1,37 @@
+# สกัดคุณลักษณะ (mel spectrogram) สำหรับ Train.py
+# แยกไว้ในโมดูลที่ไม่ import tensorflow/matplotlib เพราะ worker ของ ProcessPoolExecutor
+# บน Windows ถูก spawn และ import โมดูลของฟังก์ชันที่ส่งไปใหม่ทุก process
+import librosa
+import numpy as np
+
+SAMPLE_RATE = 16000 
+MAX_LEN = 128       
+N_MELS = 128        
+
+
+def compute_features(file_path, sr=SAMPLE_RATE, n_mels=N_MELS, max_len=MAX_LEN):
+    y, sr = librosa.load(file_path, sr=sr)
+    mel_spec = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=n_mels)
+    features = librosa.power_to_db(mel_spec, ref=np.max)
+    if features.shape[1] < max_len:
+        pad_width = max_len - features.shape[1]
+        features = np.pad(features, pad_width=((0, 0), (0, pad_width)), mode='constant')
+    else:
+        features = features[:, :max_len]
+    features = np.expand_dims(features, axis=-1)
+    return features
+
+def extract_features(file_path, sr=SAMPLE_RATE, n_mels=N_MELS, max_len=MAX_LEN):
+    try:
+        return compute_features(file_path, sr=sr, n_mels=n_mels, max_len=max_len)
+    except Exception as e:
+        return None 
+
+def extract_features_or_error(file_path):
+    try:
+        features = compute_features(file_path)
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+    if features.shape != (N_MELS, MAX_LEN, 1):
+        return None, f"unexpected feature shape {features.shape}"
+    return features, None